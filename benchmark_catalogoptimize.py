@@ -0,0 +1,285 @@
+"""
+Benchmarks for catalogoptimize.py.
+
+Run this as a `zopectl run` script via for example:
+
+  $ bin/instance run benchmark_catalogoptimize.py
+
+This does not touch the site database: the trees are created in a
+temporary FileStorage, shaped like the trees of real catalogs.
+For each tree it reports before and after optimizing:
+
+- buckets: number of buckets, including those of nested trees
+- objects and bytes: persistent objects and pickle bytes of the tree
+- loads and load time: object loads needed to read the whole tree
+  with a cold cache
+
+Plus the runtime of new_tree and optimize_tree, and the peak memory of
+Python allocations during optimize_tree.
+
+Options:
+
+  --size=100000 number of documents in the synthetic catalog
+  --stream-buckets=1000 use the streaming mode of catalogoptimize.py
+  --json=baseline.json also write the results to a JSON file
+
+For updates and more such scripts, see https://github.com/zestsoftware/plonescripts
+"""
+
+import argparse
+import json
+import os
+import random
+import runpy
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import transaction
+import ZODB
+from BTrees.IIBTree import IIBTree
+from BTrees.IIBTree import IITreeSet
+from BTrees.IOBTree import IOBTree
+from BTrees.OIBTree import OIBTree
+from BTrees.OOBTree import OOBTree
+from ZODB.FileStorage import FileStorage
+from ZODB.serialize import referencesf
+
+
+def dateindex_unindex(size):
+    # DateIndex _unindex: docid -> date, docids added in sequence.
+    tree = IIBTree()
+    for docid in range(size):
+        tree[docid] = 1000000 + docid // 10
+    return tree
+
+
+def uuid_index(size):
+    # UUIDIndex _index: random uuid -> docid.
+    tree = OIBTree()
+    for docid in range(size):
+        tree["%032x" % random.getrandbits(128)] = docid
+    return tree
+
+
+def keyword_index(size):
+    # KeywordIndex _index: keyword -> treeset of docids, added at random.
+    tree = OOBTree()
+    for number in range(50):
+        docids = random.sample(range(size), max(1, size // (number + 2)))
+        tree["keyword%d" % number] = IITreeSet(docids)
+    return tree
+
+
+def zctextindex_wordinfo(size):
+    # ZCTextIndex _wordinfo: wid -> {docid: score}.
+    # Like ZCTextIndex, use a dict for words in at most 10 documents.
+    tree = IOBTree()
+    for wid in range(max(1, size // 100)):
+        docids = random.sample(range(size), max(1, (size // 10) // (wid + 1)))
+        if len(docids) > 10:
+            scores = IIBTree()
+        else:
+            scores = {}
+        for docid in docids:
+            scores[docid] = random.randint(1, 1000)
+        tree[wid] = scores
+    return tree
+
+
+def zctextindex_docwords(size):
+    # ZCTextIndex _docwords: docid -> encoded wids, docids are random.
+    tree = IOBTree()
+    for docid in random.sample(range(size * 10), size):
+        tree[docid] = os.urandom(random.randint(20, 200))
+    return tree
+
+
+CASES = [
+    ("dateindex_unindex", dateindex_unindex),
+    ("uuid_index", uuid_index),
+    ("keyword_index", keyword_index),
+    ("zctextindex_wordinfo", zctextindex_wordinfo),
+    ("zctextindex_docwords", zctextindex_docwords),
+]
+
+
+def count_buckets(tree):
+    # Buckets of the tree and of all trees in its values.
+    distribution, _ = catalogoptimize["blen"](tree._firstbucket)
+    result = sum(distribution.values())
+    if catalogoptimize["has_tree_values"](tree):
+        for value in tree.values():
+            if catalogoptimize["is_tree"](value) and value._firstbucket is not None:
+                result += count_buckets(value)
+    return result
+
+
+def footprint(storage, oid):
+    # Number of persistent objects reachable from oid, and their pickle bytes.
+    seen = set()
+    todo = [oid]
+    size = 0
+    while todo:
+        oid = todo.pop()
+        if oid in seen:
+            continue
+        seen.add(oid)
+        data, serial = storage.load(oid, "")
+        size += len(data)
+        todo.extend(referencesf(data))
+    return (len(seen), size)
+
+
+def read_all(tree):
+    if catalogoptimize["has_tree_values"](tree):
+        for value in tree.values():
+            if catalogoptimize["is_tree"](value):
+                read_all(value)
+    else:
+        for key in tree.keys():
+            pass
+
+
+def measure(db, name):
+    # Measure with a cold cache.
+    conn = db.open()
+    conn.cacheMinimize()
+    conn.getTransferCounts(clear=True)
+    tree = conn.root()[name]
+    start = time.time()
+    read_all(tree)
+    load_time = time.time() - start
+    loads, stores = conn.getTransferCounts(clear=True)
+    objects, size = footprint(db.storage, tree._p_oid)
+    result = {
+        "buckets": count_buckets(tree),
+        "objects": objects,
+        "bytes": size,
+        "loads": loads,
+        "load_time": load_time,
+    }
+    conn.close()
+    return result
+
+
+def run_case(db, name, factory):
+    conn = db.open()
+    root = conn.root()
+    root[name] = factory(options.size)
+    transaction.commit()
+    before = measure(db, name)
+
+    # new_tree only, without committing.
+    conn.cacheMinimize()
+    start = time.time()
+    catalogoptimize["new_tree"](root[name], 0.9)
+    new_tree_time = time.time() - start
+    transaction.abort()
+
+    conn.cacheMinimize()
+    tracemalloc.start()
+    start = time.time()
+    saved, distribution = catalogoptimize["optimize_tree"](
+        root, name, root[name], attr=False
+    )
+    saved += catalogoptimize["optimize_nested"](root[name])
+    optimize_time = time.time() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    transaction.commit()
+    conn.close()
+    after = measure(db, name)
+    return {
+        "before": before,
+        "after": after,
+        "saved": saved,
+        "new_tree_time": new_tree_time,
+        "optimize_time": optimize_time,
+        "peak_memory": peak,
+    }
+
+
+def print_result(name, result):
+    print("")
+    print(
+        "%s: new_tree %.2fs, optimize %.2fs, peak memory %.1f MB, saved %d buckets"
+        % (
+            name,
+            result["new_tree_time"],
+            result["optimize_time"],
+            result["peak_memory"] / 1024.0 / 1024.0,
+            result["saved"],
+        )
+    )
+    print("         buckets   objects       bytes     loads  load time")
+    for when in ("before", "after"):
+        info = result[when]
+        print(
+            "%-7s %8d %9d %11d %9d %9.2fs"
+            % (
+                when,
+                info["buckets"],
+                info["objects"],
+                info["bytes"],
+                info["loads"],
+                info["load_time"],
+            )
+        )
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--size",
+    default=100000,
+    type=int,
+    dest="size",
+    help="Number of documents in the synthetic catalog. Default 100000.",
+)
+parser.add_argument(
+    "--stream-buckets",
+    default=0,
+    type=int,
+    dest="stream_buckets",
+    help="Use the streaming mode of catalogoptimize.py with this many buckets.",
+)
+parser.add_argument(
+    "--json",
+    default="",
+    dest="json",
+    help="Also write the results to this JSON file.",
+)
+# sys.argv will be something like:
+# ['.../parts/instance/bin/interpreter', '-c',
+#  'benchmark_catalogoptimize.py', '--size=100000']
+# Ignore the first three.
+options = parser.parse_args(args=sys.argv[3:])
+
+# Load the functions from catalogoptimize.py next to this script.
+here = os.path.dirname(os.path.abspath(sys.argv[2]))
+catalogoptimize = runpy.run_path(
+    os.path.join(here, "catalogoptimize.py"),
+    init_globals={"BENCHMARK": True},
+    run_name="catalogoptimize",
+)
+catalogoptimize["options"].stream_buckets = options.stream_buckets
+
+# Same trees for each run with the same size.
+random.seed(options.size)
+tmpdir = tempfile.mkdtemp()
+try:
+    db = ZODB.DB(FileStorage(os.path.join(tmpdir, "Data.fs")))
+    results = {}
+    for name, factory in CASES:
+        results[name] = run_case(db, name, factory)
+        print_result(name, results[name])
+    db.close()
+finally:
+    shutil.rmtree(tmpdir)
+
+if options.json:
+    with open(options.json, "w") as json_file:
+        json.dump(results, json_file, indent=2, sort_keys=True)
+    print("Wrote results to %s" % options.json)
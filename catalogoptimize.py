@@ -7,19 +7,90 @@ Run this as a `zopectl run` script via for example:
 
 Note that it does actual transaction commits.
 
+To only get a JSON report of the bucket fill rates and the number of
+buckets an optimization would save, without changing anything:
+
+  $ bin/instance run catalogoptimize.py --report=report.json
+
+To split a long run over several maintenance windows, record the finished
+trees in a checkpoint file, and skip them in the next run:
+
+  $ bin/instance run catalogoptimize.py --checkpoint=checkpoint.json
+  $ bin/instance run catalogoptimize.py --checkpoint=checkpoint.json --resume
+
+By default the metadata of portal_catalog is skipped, because it takes
+too much memory. In streaming mode memory use is bounded, so it is
+optimized too:
+
+  $ bin/instance run catalogoptimize.py --stream-buckets=1000
+
+To see whether the optimization pays off, run catalog queries with an
+empty cache before and after, and compare object loads and latency.
+Use --queries=queries.json for your own list of queries:
+
+  $ bin/instance run catalogoptimize.py --probe=probe.json
+
+To run during business hours on a busy ZEO server, limit the write rate,
+pause after each commit, and back off when commits get slow.  In this
+online mode we also wait a bit after a conflict error:
+
+  $ bin/instance run catalogoptimize.py --max-bytes-per-second=1000000 --pause=1
+
+On ZEO, the indexes can be optimized in parallel worker processes:
+
+  $ bin/instance run catalogoptimize.py --workers=4
+
+At the end, the storage footprint of the rewritten trees is printed per
+index, per site and in total: buckets and estimated pickle bytes before
+and after, bytes appended to the storage, an estimate of the bytes a pack
+can reclaim, and the change in objects and bytes for the ZODB cache limits.
+
 For updates and more such scripts, see https://github.com/zestsoftware/plonescripts
 """
 
+import argparse
+import json
+import os
+import runpy
+import sys
+import time
 from collections import defaultdict
 from datetime import datetime
 
 import transaction
 from Acquisition import aq_base
-from BTrees.IOBTree import IOBTree
-from BTrees.OOBTree import OOBTree
+from Products.ZCatalog.Catalog import Catalog
 from Products.ZCatalog.ZCatalog import ZCatalog
 from Products.ZCTextIndex.Lexicon import Lexicon
 from Products.ZCTextIndex.ZCTextIndex import ZCTextIndex
+from ZODB.POSException import ConflictError
+from ZODB.utils import oid_repr
+
+# Number of times we try a tree again after a conflict error.
+RETRIES = 3
+# Size of the header of a data record in a FileStorage.
+DATA_RECORD_HEADER = 42
+# Number of values after which we call cacheGC, when looking for nested trees.
+# Small trees are loaded but not optimized, so nothing else removes them.
+NESTED_GC_EVERY = 1000
+# Maximum number of seconds to back off after slow commits or conflicts.
+MAX_BACKOFF = 60
+# Number of brains the query probe wakes up for each query.
+PROBE_BRAINS = 20
+# Queries for the query probe, when no --queries file is given.
+# {site_path} is replaced by the path of the Plone Site.
+DEFAULT_QUERIES = [
+    {"path": {"query": "{site_path}", "depth": 1}},
+    {"portal_type": "Document", "sort_on": "modified", "sort_limit": 20},
+    {
+        "review_state": "published",
+        "sort_on": "effective",
+        "sort_order": "reverse",
+        "sort_limit": 20,
+    },
+    {"Subject": "news"},
+    {"SearchableText": "news"},
+]
 
 
 def blen(bucket, track_objects=False):
@@ -36,10 +107,36 @@ def blen(bucket, track_objects=False):
     return (distribution, objects)
 
 
+def stream_blen(bucket, jar, every, readCurrent=None, objects=None):
+    # Like blen, but turn each bucket into a ghost after counting it,
+    # so memory use does not depend on the size of the tree.
+    # Ghosts are small, so they can still be kept in objects.
+    # A single bucket is stored inline in its tree, and has no jar.
+    distribution = defaultdict(int)
+    count = 0
+    while bucket is not None:
+        distribution[len(bucket)] += 1
+        if readCurrent is not None and bucket._p_jar is not None:
+            readCurrent(bucket)
+        if objects is not None:
+            objects.append(bucket)
+        next_bucket = bucket._next
+        bucket._p_deactivate()
+        bucket = next_bucket
+        count += 1
+        if jar is not None and count % every == 0:
+            jar.cacheGC()
+    return distribution
+
+
 def get_max_bucket_size(data):
     # Data is tree or treeset.
     # We calculate instead of hardcoding because values can be patched.
-    tmp = data.__class__()
+    # This is the same for all trees of a class, so calculate it only once.
+    klass = data.__class__
+    if klass in max_bucket_sizes:
+        return max_bucket_sizes[klass]
+    tmp = klass()
     if hasattr(tmp, "items"):
         update = lambda x: (x, x)
     else:
@@ -51,9 +148,40 @@ def get_max_bucket_size(data):
         count += 1
         tmp.update([update(count)])
     # Buckets are split on count
+    max_bucket_sizes[klass] = count
     return count
 
 
+def count_tree(tree):
+    # Keep a summary of the tree classes we find, with their limits.
+    name = tree.__class__.__name__
+    if name not in tree_summary:
+        tree_summary[name] = {
+            "trees": 0,
+            "max_bucket_size": get_max_bucket_size(tree),
+            "max_internal_size": get_max_internal_size(tree.__class__),
+        }
+    tree_summary[name]["trees"] += 1
+
+
+def merge_tree_summary(summary):
+    for name, info in summary.items():
+        if name not in tree_summary:
+            tree_summary[name] = dict(info)
+        else:
+            tree_summary[name]["trees"] += info["trees"]
+
+
+def print_tree_summary():
+    print("Tree classes found:")
+    for name, info in sorted(tree_summary.items()):
+        print(
+            "- {}: {} trees, max bucket size {}, max internal size {}".format(
+                name, info["trees"], info["max_bucket_size"], info["max_internal_size"]
+            )
+        )
+
+
 def get_bucket_sizes(bucket):
     sizes = []
     while bucket is not None:
@@ -62,128 +190,229 @@ def get_bucket_sizes(bucket):
     return sizes
 
 
-def new_tree(old_tree, modfactor=9):
-    # Fill the tree in a two-step process, which should result in better
-    # fill rates
-    klass = old_tree.__class__
+def get_bucket_class(klass):
+    # OOBTree -> OOBucket, IITreeSet -> IISet.
+    bucket_class = getattr(klass, "_bucket_type", None)
+    if bucket_class is None:
+        # Older BTrees versions do not have this attribute.
+        module = sys.modules[klass.__module__]
+        name = klass.__name__.replace("TreeSet", "Set").replace("BTree", "Bucket")
+        bucket_class = getattr(module, name)
+    return bucket_class
+
+
+def get_max_internal_size(klass):
+    # Older BTrees versions do not have this attribute.
+    # 250 is the lowest default of all families.
+    return getattr(klass, "max_internal_size", 250)
+
+
+def chunked(items, size, mapping=True):
+    # Yield flat tuples in bucket state format with size items each:
+    # (k0, v0, k1, v1, ...) for BTrees, (k0, k1, ...) for tree sets.
+    chunk = []
+    if mapping:
+        size *= 2
+    for item in items:
+        if mapping:
+            chunk.extend(item)
+        else:
+            chunk.append(item)
+        if len(chunk) == size:
+            yield tuple(chunk)
+            chunk = []
+    if chunk:
+        yield tuple(chunk)
+
+
+def node_state(children):
+    # (child0, key1, child1, key2, child2, ...)
+    state = [children[0][1]]
+    for key, child, firstbucket in children[1:]:
+        state.append(key)
+        state.append(child)
+    return tuple(state)
+
+
+def set_bucket_state(bucket, state):
+    # After a savepoint the bucket may be a ghost: load it first,
+    # otherwise its old state would be loaded over the new one later.
+    bucket._p_activate()
+    bucket.__setstate__(state)
+    if bucket._p_jar is not None:
+        bucket._p_changed = True
+
+
+def build_tree(klass, items, bucket_size, mapping=True, jar=None, every=0):
+    # Bulk load a new tree from items that are already sorted.
+    # Every bucket gets exactly bucket_size items, except the last one.
+    # A bucket is linked to an empty successor, which gets filled when
+    # the next chunk is read, so we only need one pass.
+    # With every, write the new buckets to a savepoint every so many
+    # buckets, so the cache can turn them into ghosts.
     new = klass()
-    count = 0
-    tmp = []
-    # If the last bucket is not 50% full after first run (it is fuller), it is likely
-    # to split on second run, and the last 3 buckets will have lower fill rates,
-    # instead of just the last one.
-    # Idea: keep the tmp the same size as max and start on 2nd run inbetween 1st run
-    # but with a max size delay
+    bucket_class = get_bucket_class(klass)
+    # children is a list of (first key, node, first bucket of node).
+    children = []
+    bucket = None
+    pending = None
+    for chunk in chunked(items, bucket_size, mapping=mapping):
+        if bucket is None:
+            bucket = bucket_class()
+            if every:
+                # The other new buckets are reachable from this one.
+                jar.add(bucket)
+        else:
+            next_bucket = bucket_class()
+            set_bucket_state(bucket, (pending, next_bucket))
+            bucket = next_bucket
+        pending = chunk
+        children.append((chunk[0], bucket, bucket))
+        if every and len(children) % every == 0:
+            transaction.savepoint(optimistic=True)
+            jar.cacheGC()
+    if bucket is None:
+        return new
+    set_bucket_state(bucket, (pending,))
+
+    # Stack full internal nodes on top of the buckets until one root is left.
+    max_internal_size = get_max_internal_size(klass)
+    while len(children) > max_internal_size:
+        parents = []
+        for start in range(0, len(children), max_internal_size):
+            group = children[start : start + max_internal_size]
+            node = klass()
+            node.__setstate__((node_state(group), group[0][2]))
+            parents.append((group[0][0], node, group[0][2]))
+        children = parents
+    new.__setstate__((node_state(children), children[0][2]))
+    return new
+
+
+def get_bucket_size(maxsize, fill):
+    return max(1, int(round(maxsize * fill)))
+
+
+def get_fill_rate(avgrate, medianrate):
+    # We want to set optimal fill rates based on current fill rate.
+    # Fill rates of 55% or below indicates sequential index like dateindex
+    # and we want 100% fill rate, otherwise 90% is good.
+    if avgrate < 0.55 or medianrate < 0.55 or medianrate > 0.95:
+        return 1.0
+    return 0.9
+
+
+def is_unoptimized(distribution):
+    # do we have bucket lengths more than one which exist and aren't 90% full?
+    # we assume here that 90% is one of 27, 54 or 108
+    try:
+        return any([a % 9 for a, b in distribution.items() if b > 1])
+    except NameError:
+        # Python 2.4 doesn't have any, we'll just loop over all items
+        return bool([a % 9 for a, b in distribution.items() if b > 1])
+
+
+def bucket_stats(distribution, maxsize):
+    # Gather stats used to figure out the fill rate
+    buckets = sum(distribution.values())
+    items = sum([kk * vv for kk, vv in distribution.items()])
+    averagesize = items * 1.0 / buckets
+    bucketsizes = [
+        x
+        for sublist in [(kk,) * vv for kk, vv in sorted(distribution.items())]
+        for x in sublist
+    ]
+    median = bucketsizes[buckets // 2]
+    avgrate = float(averagesize) / maxsize
+    medianrate = float(median) / maxsize
+    fill = get_fill_rate(avgrate, medianrate)
+    # Number of buckets after optimizing: all full except the last one.
+    bucket_size = get_bucket_size(maxsize, fill)
+    optimized = (items + bucket_size - 1) // bucket_size
+    return {
+        "buckets": buckets,
+        "items": items,
+        "max_bucket_size": maxsize,
+        "average": averagesize,
+        "median": median,
+        "avgrate": avgrate,
+        "medianrate": medianrate,
+        "fill": fill,
+        "optimized_buckets": optimized,
+    }
+
+
+def new_tree(old_tree, fill=0.9, every=0):
+    # Stream the sorted items of the old tree straight into buckets
+    # that are filled at the given rate.
+    bucket_size = get_bucket_size(get_max_bucket_size(old_tree), fill)
+    jar = old_tree._p_jar
     if hasattr(old_tree, "items"):
         # BTree
-        for k, v in old_tree.items():
-            modcount = count % modfactor
-            if modcount % 2 == 0:
-                new[k] = v
-            else:
-                tmp.append((k, v))
-            count += 1
+        new = build_tree(
+            old_tree.__class__, old_tree.items(), bucket_size, jar=jar, every=every
+        )
     else:
         # Tree set
-        for k in old_tree.keys():
-            modcount = count % modfactor
-            if modcount % 2 == 0:
-                new.insert(k)
-            else:
-                tmp.append(k)
-            count += 1
-
-    # Before adding the rest of the data, we need to make sure the last bucket
-    # is not more than 50% full.
-    # Add and remove synthetic values to provoke a bucket split
-    maxsize = get_max_bucket_size(new)
-    maxkey = new.maxKey()
-    if isinstance(maxkey, int):
-        synthetic = range(
-            maxkey + 1, maxkey + 2 + (maxsize - get_bucket_sizes(new._firstbucket)[-1])
+        new = build_tree(
+            old_tree.__class__,
+            old_tree.keys(),
+            bucket_size,
+            mapping=False,
+            jar=jar,
+            every=every,
         )
-    elif isinstance(maxkey, str):
-        synthetic = [
-            maxkey + str(x)
-            for x in range((maxsize - get_bucket_sizes(new._firstbucket)[-1]) + 1)
-        ]
-    else:
-        synthetic = []
 
-    if hasattr(new, "items"):
-        for s in synthetic:
-            new[s] = 0
-        for s in synthetic:
-            del new[s]
-    else:
-        for s in synthetic:
-            new.insert(s)
-        for s in synthetic:
-            new.remove(s)
-
-    # Add the rest of the data
-    new.update(tmp)
-
-    # Verify data
-    assert len(old_tree) == len(new)
+    # Verify data.  When streaming, len would load all buckets at once,
+    # so optimize_tree compares the bucket distributions instead.
+    if not every:
+        assert len(old_tree) == len(new)
     return new
 
 
 def optimize_tree(parent, k, v, attr=True):
+    # Returns (number of buckets optimized away, bucket distribution of
+    # the tree that is in place afterwards), or (0, None) for no tree.
     transaction.begin()
     bucket = getattr(v, "_firstbucket", None)
     if bucket is None:
-        return 0
-    readCurrent = getattr(bucket._p_jar, "readCurrent", None)
-    if readCurrent is not None:
-        track_objects = True
+        return (0, None)
+    count_tree(v)
+    # A single bucket is stored inline in the tree, without a jar of its own.
+    jar = v._p_jar
+    readCurrent = getattr(jar, "readCurrent", None)
+    every = options.stream_buckets
+    if every:
+        # Mark the buckets as read right away, and only keep ghosts.
+        objects = []
+        before_distribution = stream_blen(
+            bucket, jar, every, readCurrent, objects=objects
+        )
     else:
-        track_objects = False
-    before_distribution, objects = blen(bucket, track_objects=track_objects)
+        # Keep the buckets for readCurrent and the footprint accounting.
+        before_distribution, objects = blen(bucket, track_objects=True)
 
-    # do we have bucket lengths more than one which exist and aren't 90% full?
-    # we assume here that 90% is one of 27, 54 or 108
-    try:
-        unoptimized = any([a % 9 for a, b in before_distribution.items() if b > 1])
-    except NameError:
-        # Python 2.4 doesn't have any, we'll just loop over all items
-        unoptimized = bool([a % 9 for a, b in before_distribution.items() if b > 1])
-
-    if unoptimized:
-        # Gather stats used to figure out modfactor
-        before = sum(before_distribution.values())
-        maxsize = get_max_bucket_size(v)
-        averagesize = (
-            sum([kk * vv for kk, vv in before_distribution.items()]) * 1.0 / before
-        )
-        bucketsizes = [
-            x
-            for sublist in [
-                (kk,) * vv for kk, vv in sorted(before_distribution.items())
-            ]
-            for x in sublist
-        ]
-        median = bucketsizes[before // 2]
-
-        # Filling the tree in a two-step process. The first time we set up the tree,
-        # values are inserted sequentially, resulting in 50% fill rate.
-        # The second time we fill up with additional values to get fill rate higher
-        # than 50%.
-        # We want to set optimal fill rates based on current fill rate.
-        # Fill rates of 55% or below indicates sequential index like dateindex
-        # and we want 100% fill rate, otherwise 90% is good.
-        avgrate = float(averagesize) / maxsize
-        medianrate = float(median) / maxsize
-        if avgrate < 0.55 or medianrate < 0.55 or medianrate > 0.95:
-            modfactor = 2  # same number of items in both runs gives 100% fill
-        else:
-            modfactor = 9  # 5 in first run and 4 in second run gives 90% fill rate
+    if is_unoptimized(before_distribution):
+        stats = bucket_stats(before_distribution, get_max_bucket_size(v))
+        before = stats["buckets"]
+        maxsize = stats["max_bucket_size"]
+        avgrate = stats["avgrate"]
+        fill = stats["fill"]
 
-        new = new_tree(v, modfactor)
-        after_distribution, _ = blen(new._firstbucket)
+        new = new_tree(v, fill, every=every)
+        if every:
+            new_buckets = []
+            after_distribution = stream_blen(
+                new._firstbucket, jar, every, objects=new_buckets
+            )
+            assert stats["items"] == sum(
+                [kk * vv for kk, vv in after_distribution.items()]
+            )
+        else:
+            after_distribution, new_buckets = blen(new._firstbucket, track_objects=True)
         after = sum(after_distribution.values())
         if after < before:
-            if readCurrent is not None:
+            if readCurrent is not None and not every:
                 for obj in objects:
                     readCurrent(obj)
             if attr:
@@ -206,64 +435,775 @@ def optimize_tree(parent, k, v, attr=True):
                 "New buckets {fill size: count}: %s\nSingle buckets: %s\nfill: before %.3f after %.3f"
                 % (str(many_buckets), str(few_buckets), avgrate, newavgrate)
             )
-            transaction.commit()
-            return before - after
+            written = commit_tree(jar)
+            account_tree(objects, new_buckets, written)
+            return (before - after, after_distribution)
 
     conn = parent._p_jar
     if conn:
         conn.cacheGC()
     transaction.abort()
-    return 0
+    return (0, before_distribution)
+
+
+def is_throttled():
+    return bool(options.max_bytes_per_second or options.pause or options.slow_commit)
+
+
+def commit_tree(jar):
+    # Commit, and return the number of bytes written.  The growth of the
+    # storage is an estimate of this: on ZEO it includes commits of others.
+    # When throttling, wait to keep the write rate under the limit and give
+    # other clients room.
+    db = jar.db()
+    size = db.getSize()
+    start = time.time()
+    transaction.commit()
+    duration = time.time() - start
+    written = max(0, db.getSize() - size)
+    if not is_throttled():
+        return written
+    delay = options.pause
+    if options.max_bytes_per_second:
+        delay = max(delay, written / options.max_bytes_per_second - duration)
+    if options.slow_commit:
+        if duration > options.slow_commit:
+            throttle["backoff"] = min(MAX_BACKOFF, max(1, throttle["backoff"] * 2))
+            print(
+                "Slow commit of {:.1f} seconds, backing off {} seconds.".format(
+                    duration, throttle["backoff"]
+                )
+            )
+        else:
+            throttle["backoff"] = throttle["backoff"] // 2
+        delay += throttle["backoff"]
+    if delay > 0:
+        time.sleep(delay)
+    return written
+
+
+def account_tree(old_buckets, new_buckets, written):
+    # Add the storage footprint of a rewritten tree to the totals.
+    # ZODB sets _p_estimated_size to the pickle size, rounded up to 64 bytes,
+    # when it loads or stores an object, also for ghosts, so this costs
+    # no extra loads.  A single bucket is stored inline in its tree,
+    # so it counts as zero bytes.
+    old_bytes = sum([obj._p_estimated_size for obj in old_buckets])
+    new_bytes = sum([obj._p_estimated_size for obj in new_buckets])
+    footprint["trees"] += 1
+    footprint["old_buckets"] += len(old_buckets)
+    footprint["new_buckets"] += len(new_buckets)
+    footprint["old_bytes"] += old_bytes
+    footprint["new_bytes"] += new_bytes
+    footprint["appended"] += written
+    # The old buckets are garbage now.  Packing removes at least their
+    # current data record, and their older records if they still exist.
+    footprint["reclaimable"] += old_bytes + DATA_RECORD_HEADER * len(old_buckets)
+
+
+def footprint_since(start):
+    return dict([(key, footprint[key] - start.get(key, 0)) for key in footprint])
+
+
+def add_footprint(prefix, delta):
+    totals = footprints.setdefault(prefix, defaultdict(int))
+    for key, value in delta.items():
+        totals[key] += value
+
+
+def print_footprint(name, totals):
+    # The cache limits of ZODB count objects, and estimate their size
+    # with the size of their pickle.
+    print(
+        "{}: {} trees, buckets {} -> {}, bytes {} -> {}, "
+        "appended {}, reclaimable at pack {}, "
+        "cache {:+d} objects {:+d} bytes".format(
+            name,
+            totals["trees"],
+            totals["old_buckets"],
+            totals["new_buckets"],
+            totals["old_bytes"],
+            totals["new_bytes"],
+            totals["appended"],
+            totals["reclaimable"],
+            totals["new_buckets"] - totals["old_buckets"],
+            totals["new_bytes"] - totals["old_bytes"],
+        )
+    )
 
 
-def optimize(obj, no_data=False):
+def print_footprints():
+    print("Storage footprint of rewritten trees:")
+    sites = {}
+    total = defaultdict(int)
+    for prefix, totals in sorted(footprints.items()):
+        print_footprint(prefix, totals)
+        site_totals = sites.setdefault(prefix.split("/")[0], defaultdict(int))
+        for key, value in totals.items():
+            site_totals[key] += value
+            total[key] += value
+    for site_id, site_totals in sorted(sites.items()):
+        print_footprint('site "{}"'.format(site_id), site_totals)
+    print_footprint("total", total)
+
+
+def optimize_tree_retry(parent, k, attr=True):
+    # Another client may have changed the tree while we were rebuilding it.
+    # Get the current version of the tree and try again.
+    for attempt in range(RETRIES + 1):
+        if attr:
+            v = getattr(parent, k)
+        else:
+            v = parent[k]
+        try:
+            return optimize_tree(parent, k, v, attr=attr)
+        except ConflictError:
+            transaction.abort()
+            if attempt == RETRIES:
+                raise
+            print("Conflict while optimizing {}, retrying.".format(k))
+            if is_throttled():
+                # Give the other clients some time.
+                time.sleep(min(MAX_BACKOFF, 2**attempt))
+
+
+def tree_fingerprint(tree, distribution):
+    # Use the bucket distribution that optimize_tree has computed anyway,
+    # so we do not load all buckets again.
+    # Returns None for anything that is not a stored tree.
+    oid = getattr(tree, "_p_oid", None)
+    if distribution is None or oid is None:
+        return None
+    return {
+        "oid": oid_repr(oid),
+        "length": sum([kk * vv for kk, vv in distribution.items()]),
+        "buckets": sum(distribution.values()),
+    }
+
+
+def load_checkpoint():
+    if not (options.resume and os.path.exists(options.checkpoint)):
+        return {}
+    with open(options.checkpoint) as checkpoint_file:
+        return json.load(checkpoint_file)
+
+
+def is_finished(key, tree):
+    # Compare the oid first, so we do not need to load any buckets
+    # for a tree that was replaced after our run: an optimized tree is
+    # a new object.  Then compare the length and bucket count, so a tree
+    # that has grown or shrunk since then is optimized again.
+    # This walks the bucket chain once, but skips building a new tree
+    # and committing it, and the trees nested in it.
+    if not options.resume:
+        return False
+    fingerprint = checkpoint.get(key)
+    if fingerprint is None:
+        return False
+    oid = getattr(tree, "_p_oid", None)
+    if oid is None or oid_repr(oid) != fingerprint["oid"]:
+        return False
+    bucket = getattr(tree, "_firstbucket", None)
+    if bucket is None:
+        return False
+    jar = tree._p_jar
+    if options.stream_buckets:
+        distribution = stream_blen(bucket, jar, options.stream_buckets)
+    else:
+        distribution, _ = blen(bucket)
+        jar.cacheGC()
+    current = tree_fingerprint(tree, distribution)
+    return (current["length"], current["buckets"]) == (
+        fingerprint["length"],
+        fingerprint["buckets"],
+    )
+
+
+def mark_finished(key, tree, distribution):
+    if not options.checkpoint:
+        return
+    fingerprint = tree_fingerprint(tree, distribution)
+    if fingerprint is None:
+        return
+    fingerprint["finished"] = datetime.now().isoformat()
+    checkpoint[key] = fingerprint
+    if options.workers:
+        # Workers hand their entries to the main process, which saves them.
+        return
+    save_checkpoint()
+
+
+def save_checkpoint():
+    # Write to a temporary file first, so an interrupted run cannot leave
+    # a broken checkpoint behind.
+    tmp_name = options.checkpoint + ".tmp"
+    with open(tmp_name, "w") as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file, indent=2, sort_keys=True)
+    os.rename(tmp_name, options.checkpoint)
+
+
+def is_tree(obj):
+    # Check the class name, so we do not load the object.
+    name = obj.__class__.__name__
+    return name.endswith("BTree") or name.endswith("TreeSet")
+
+
+def has_tree_values(tree):
+    # Only trees with object values, like IOBTree, OOBTree and LOBTree,
+    # can contain other trees.  Iterating over the values of an IIBTree
+    # would load all its buckets for nothing.
+    name = tree.__class__.__name__
+    return name.endswith("BTree") and name[1:2] == "O"
+
+
+def has_nested_trees(obj, k, v):
+    # The data of a Catalog maps docids to metadata tuples, never to trees.
+    # Iterating over its values would only load all metadata.
+    if k == "data" and isinstance(obj, Catalog):
+        return False
+    return is_tree(v) and has_tree_values(v)
+
+
+def is_small_tree(tree):
+    # Look at the state of the root node only, so no buckets are loaded.
+    state = tree.__getstate__()
+    if state is None:
+        # Empty
+        return True
+    if len(state) == 1:
+        # A tree with one bucket keeps its items inline in the root.
+        buckets = 1
+    elif isinstance(state[0][0], tree.__class__):
+        # The root has internal nodes below it.
+        return False
+    else:
+        # (bucket0, key1, bucket1, ...)
+        buckets = (len(state[0]) + 1) // 2
+    return buckets < options.min_buckets
+
+
+def optimize_nested(tree):
+    # Optimize the trees in the values of this tree, at any depth.
+    result = 0
+    if not has_tree_values(tree):
+        return result
+    jar = tree._p_jar
+    for count, k in enumerate(list(tree.keys()), 1):
+        if jar is not None and count % NESTED_GC_EVERY == 0:
+            jar.cacheGC()
+        v = tree[k]
+        if not is_tree(v):
+            continue
+        # A small tree may still have big trees in its values.
+        if not is_small_tree(v):
+            result += optimize_tree_retry(tree, k, attr=False)[0]
+        result += optimize_nested(tree[k])
+    return result
+
+
+def optimize(obj, no_data=False, prefix=""):
     obj = aq_base(obj)
     result = 0
     obj._p_activate()
-    for k, v in obj.__dict__.items():
+    # Take a copy: after a conflict the object may be turned into a ghost.
+    for k, v in list(obj.__dict__.items()):
         if no_data and k == "data":
             # data blows up memory too much
             continue
-        result += optimize_tree(obj, k, v)
-        # handle sets inside *OBTrees
-        if isinstance(v, (IOBTree, OOBTree)):
-            obj._p_activate()
-            new_v = obj.__dict__[k]
-            for k2, v2 in new_v.iteritems():
-                result += optimize_tree(new_v, k2, v2, attr=False)
+        key = "{}/{}".format(prefix, k)
+        if is_finished(key, v):
+            print("Skipping {}, it was finished in an earlier run.".format(key))
+            continue
+        saved, distribution = optimize_tree_retry(obj, k)
+        result += saved
+        obj._p_activate()
+        new_v = obj.__dict__[k]
+        # handle trees and sets inside trees
+        if has_nested_trees(obj, k, new_v):
+            result += optimize_nested(new_v)
+        mark_finished(key, new_v, distribution)
     print("Optimized away {} buckets in {}".format(result, obj))
     return result
 
 
-# Loop over all Plone sites
-for site in app.values():
-    if not site.meta_type == "Plone Site":
-        continue
+def analyze_tree(v):
+    # Only walk the bucket chain, do not build a new tree.
+    bucket = getattr(v, "_firstbucket", None)
+    if bucket is None:
+        return None
+    count_tree(v)
+    if options.stream_buckets:
+        distribution = stream_blen(bucket, v._p_jar, options.stream_buckets)
+    else:
+        distribution, _ = blen(bucket)
+    stats = bucket_stats(distribution, get_max_bucket_size(v))
+    stats["histogram"] = dict((str(kk), vv) for kk, vv in sorted(distribution.items()))
+    stats["unoptimized"] = is_unoptimized(distribution)
+    if stats["unoptimized"]:
+        stats["saved"] = max(0, stats["buckets"] - stats["optimized_buckets"])
+    else:
+        stats["saved"] = 0
+    return stats
+
+
+def analyze_nested(tree, nested):
+    # Add the stats of the trees in the values of this tree, at any depth.
+    if not has_tree_values(tree):
+        return
+    jar = tree._p_jar
+    for count, k in enumerate(list(tree.keys()), 1):
+        if jar is not None and count % NESTED_GC_EVERY == 0:
+            jar.cacheGC()
+        v = tree[k]
+        if not is_tree(v):
+            continue
+        # A small tree may still have big trees in its values.
+        if is_small_tree(v):
+            nested["small"] += 1
+        else:
+            stats = analyze_tree(v)
+            if stats is not None:
+                nested["trees"] += 1
+                nested["buckets"] += stats["buckets"]
+                nested["saved"] += stats["saved"]
+        analyze_nested(v, nested)
+
+
+def analyze(obj, no_data=False):
+    obj = aq_base(obj)
+    result = 0
+    report = {}
+    obj._p_activate()
+    # Take a copy: cacheGC may turn the object into a ghost.
+    for k, v in list(obj.__dict__.items()):
+        if no_data and k == "data":
+            # data blows up memory too much
+            continue
+        stats = analyze_tree(v)
+        if stats is None:
+            continue
+        result += stats["saved"]
+        # handle trees and sets inside trees
+        if has_nested_trees(obj, k, v):
+            nested = {"trees": 0, "small": 0, "buckets": 0, "saved": 0}
+            analyze_nested(v, nested)
+            stats["nested"] = nested
+            result += nested["saved"]
+        report[k] = stats
+        conn = obj._p_jar
+        if conn:
+            conn.cacheGC()
+    print("Optimizing would save {} buckets in {}".format(result, obj))
+    return (result, report)
+
+
+def probe(zcatalog, queries):
+    # Run each query with an empty cache, and record the object loads,
+    # bytes loaded and latency.
+    search = getattr(zcatalog, "unrestrictedSearchResults", zcatalog.searchResults)
+    conn = zcatalog._p_jar
+    storage = conn._storage
+    original_load = storage.load
+    loaded = []
+
+    def load(oid, *args, **kwargs):
+        data, serial = original_load(oid, *args, **kwargs)
+        loaded.append(len(data))
+        return (data, serial)
+
+    storage.load = load
+    results = []
+    try:
+        for query in queries:
+            transaction.abort()
+            conn.cacheMinimize()
+            del loaded[:]
+            start = time.time()
+            try:
+                brains = search(**query)
+                count = len(brains)
+                # Wake up the first brains, like a listing would.
+                for brain in brains[:PROBE_BRAINS]:
+                    brain.getPath()
+                error = None
+            except Exception as exc:
+                count = 0
+                error = repr(exc)
+            results.append(
+                {
+                    "query": query,
+                    "results": count,
+                    "loads": len(loaded),
+                    "bytes": sum(loaded),
+                    "latency": time.time() - start,
+                    "error": error,
+                }
+            )
+    finally:
+        storage.load = original_load
+    transaction.abort()
+    return results
+
+
+def load_queries(site_path):
+    if options.queries:
+        with open(options.queries) as queries_file:
+            queries = json.load(queries_file)
+    else:
+        queries = DEFAULT_QUERIES
+    # Queries can use {site_path}, for example in a path query.
+    return json.loads(json.dumps(queries).replace("{site_path}", site_path))
+
+
+def plone_catalogs():
+    # Yield (site, zcatalog) for all ZCatalogs in all Plone Sites.
+    for site in app.values():
+        if not site.meta_type == "Plone Site":
+            continue
+        for zcatalog in site.values():
+            if isinstance(zcatalog, ZCatalog):
+                yield (site, zcatalog)
+
 
-    site_id = site.getId()
+def probe_all(when):
     now = datetime.now().isoformat()
-    print('{} - Starting for site "{}" ...'.format(now, site_id))
-    combined = 0
-    for zcatalog in site.values():
-        if not isinstance(zcatalog, ZCatalog):
+    print("{} - Probing catalog queries {} optimizing".format(now, when))
+    for site, zcatalog in plone_catalogs():
+        site_probes = probes.setdefault(site.getId(), {})
+        catalog_probes = site_probes.setdefault(zcatalog.getId(), {})
+        queries = load_queries("/".join(site.getPhysicalPath()))
+        catalog_probes[when] = probe(zcatalog, queries)
+
+
+def print_probes():
+    for site_id, site_probes in sorted(probes.items()):
+        for zcatalog_id, catalog_probes in sorted(site_probes.items()):
+            print('Query probe for "{}" in site "{}":'.format(zcatalog_id, site_id))
+            before = catalog_probes.get("before", [])
+            after = catalog_probes.get("after", [None] * len(before))
+            for first, second in zip(before, after):
+                if first["error"]:
+                    print("- {}: {}".format(first["query"], first["error"]))
+                    continue
+                line = "- {}: {} loads, {} bytes, {:.3f}s".format(
+                    first["query"], first["loads"], first["bytes"], first["latency"]
+                )
+                if second is not None:
+                    line += " -> {} loads, {} bytes, {:.3f}s".format(
+                        second["loads"], second["bytes"], second["latency"]
+                    )
+                print(line)
+
+
+def catalog_objects(zcatalog):
+    # Yield (name, object, no_data) for everything in a ZCatalog with trees.
+    zcatalog_id = zcatalog.getId()
+    catalog = zcatalog._catalog
+    # paths, uids, data - skip data for portal_catalog, unless streaming
+    no_data = zcatalog_id == "portal_catalog" and not options.stream_buckets
+    yield ("_catalog", catalog, no_data)
+    # lexica
+    for obj in zcatalog.values():
+        if isinstance(obj, Lexicon):
+            yield (obj.getId(), obj, False)
+    # indexes
+    for index_id, index in catalog.indexes.items():
+        if isinstance(index, ZCTextIndex):
+            yield (index_id, index.index, False)
+        else:
+            yield (index_id, index, False)
+
+
+def get_catalog_object(zcatalog, name):
+    for obj_name, obj, no_data in catalog_objects(zcatalog):
+        if obj_name == name:
+            return (obj, no_data)
+    raise KeyError(name)
+
+
+def catalog_tasks(site_id, zcatalog):
+    # Yield (site id, catalog id, name) for each unit of work: one task per
+    # lexicon or index, and one for all of _catalog.  Its trees are all
+    # attributes of the same persistent object, which has no conflict
+    # resolution, so they must be replaced one after another.
+    zcatalog_id = zcatalog.getId()
+    for name, obj, no_data in catalog_objects(zcatalog):
+        yield (site_id, zcatalog_id, name)
+
+
+def optimize_task(task):
+    # Runs in a worker process, with the app of the worker.  Returns (result,
+    # checkpoint entries, tree summary, storage footprint, error).
+    # Catch errors here, so we still get the entries of the finished trees.
+    site_id, zcatalog_id, name = task
+    tree_summary.clear()
+    start = dict(footprint)
+    prefix = "/".join(task)
+    try:
+        zcatalog = getattr(getattr(app, site_id), zcatalog_id)
+        obj, no_data = get_catalog_object(zcatalog, name)
+        result = optimize(obj, no_data=no_data, prefix=prefix)
+        error = None
+    except Exception as exc:
+        transaction.abort()
+        result = 0
+        error = repr(exc)
+    entries = dict(
+        (key, value)
+        for key, value in checkpoint.items()
+        if key.startswith(prefix + "/")
+    )
+    return (result, entries, dict(tree_summary), footprint_since(start), error)
+
+
+def run_workers(tasks):
+    # Returns a dict with optimized away buckets per site.
+    # This closes the database of this process, see sitejobs.py.
+    combined = defaultdict(int)
+    errors = []
+    for task, info, error in sitejobs["run_jobs"](
+        app, tasks, optimize_task, options.workers, globals()
+    ):
+        if error is None:
+            result, entries, summary, delta, error = info
+            combined[task[0]] += result
+            merge_tree_summary(summary)
+            add_footprint("/".join(task), delta)
+            if options.checkpoint and entries:
+                checkpoint.update(entries)
+                save_checkpoint()
+        if error is not None:
+            errors.append((task, error))
+            print("ERROR optimizing {}: {}".format("/".join(task), error))
+    if errors:
+        print("{} tasks failed, run again to retry them.".format(len(errors)))
+    return combined
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--report",
+    default="",
+    dest="report",
+    help=(
+        "Only analyze the bucket fill rates and write a JSON report to this file. "
+        "No changes will be saved."
+    ),
+)
+parser.add_argument(
+    "--checkpoint",
+    default="",
+    dest="checkpoint",
+    help=(
+        "Record each finished tree with its fingerprint (oid, length, bucket count) "
+        "in this JSON file. Only used when optimizing. "
+        "Without --resume an existing file is overwritten."
+    ),
+)
+parser.add_argument(
+    "--resume",
+    action="store_true",
+    default=False,
+    dest="resume",
+    help=(
+        "Skip the trees that are recorded as finished in the checkpoint file, "
+        "when their oid, length and bucket count still match."
+    ),
+)
+parser.add_argument(
+    "--stream-buckets",
+    default=0,
+    type=int,
+    dest="stream_buckets",
+    help=(
+        "Streaming mode: turn old buckets into ghosts as we go, and take a savepoint "
+        "and call cacheGC every this many new buckets. This keeps memory bounded, "
+        "so the data of portal_catalog is optimized too."
+    ),
+)
+parser.add_argument(
+    "--min-buckets",
+    default=2,
+    type=int,
+    dest="min_buckets",
+    help=(
+        "Skip trees inside other trees that have fewer buckets than this. "
+        "This is checked on the root node, without loading any buckets. "
+        "Default 2: skip trees with a single bucket."
+    ),
+)
+parser.add_argument(
+    "--probe",
+    default="",
+    dest="probe",
+    help=(
+        "Run catalog queries with an empty cache before and after optimizing, "
+        "and write the object loads, bytes loaded and latency to this JSON file."
+    ),
+)
+parser.add_argument(
+    "--queries",
+    default="",
+    dest="queries",
+    help=(
+        "JSON file with a list of catalog queries for --probe. "
+        "{site_path} is replaced by the path of the Plone Site."
+    ),
+)
+parser.add_argument(
+    "--max-bytes-per-second",
+    default=0,
+    type=int,
+    dest="max_bytes_per_second",
+    help=(
+        "Online mode: after each commit, wait long enough to keep the average "
+        "write rate under this number of bytes per second."
+    ),
+)
+parser.add_argument(
+    "--pause",
+    default=0,
+    type=float,
+    dest="pause",
+    help="Online mode: wait this many seconds after each commit.",
+)
+parser.add_argument(
+    "--slow-commit",
+    default=0,
+    type=float,
+    dest="slow_commit",
+    help=(
+        "Online mode: when a commit takes longer than this many seconds, "
+        "back off with a pause that doubles for each slow commit."
+    ),
+)
+parser.add_argument(
+    "--workers",
+    default=0,
+    type=int,
+    dest="workers",
+    help=(
+        "Optimize _catalog and each lexicon and index in one of this many "
+        "worker processes, each with its own database connection. "
+        "Needs ZEO. Only used when optimizing."
+    ),
+)
+# benchmark_catalogoptimize.py loads this script with BENCHMARK set to True,
+# to use its functions without optimizing the catalogs of the site.
+BENCHMARK = globals().get("BENCHMARK", False)
+if BENCHMARK:
+    options = parser.parse_args(args=[])
+else:
+    # sys.argv will be something like:
+    # ['.../parts/instance/bin/interpreter', '-c',
+    #  'catalogoptimize.py', '--checkpoint=checkpoint.json', '--resume']
+    # Ignore the first three.
+    options = parser.parse_args(args=sys.argv[3:])
+if options.resume and not options.checkpoint:
+    parser.error("--resume needs --checkpoint.")
+
+report = {}
+tasks = []
+# Max bucket size per tree class.
+max_bucket_sizes = {}
+# Number of trees and limits per tree class name.
+tree_summary = {}
+checkpoint = {}
+# Query probe results per site, catalog, and before or after.
+probes = {}
+# Current back off in seconds, after slow commits.
+throttle = {"backoff": 0}
+# Storage footprint totals of all rewritten trees in this process,
+# and per site/catalog/index.
+footprint = defaultdict(int)
+footprints = {}
+
+if not BENCHMARK:
+    if options.report:
+        print("Report selected, will not commit changes.")
+
+    checkpoint = load_checkpoint()
+    if checkpoint:
+        print(
+            "Resuming, {} trees were finished in earlier runs.".format(len(checkpoint))
+        )
+
+    if options.probe:
+        probe_all("before")
+
+    # Loop over all Plone sites
+    for site in app.values():
+        if not site.meta_type == "Plone Site":
             continue
-        zcatalog_id = zcatalog.getId()
+
+        site_id = site.getId()
         now = datetime.now().isoformat()
-        print('{} - Optimizing "{}"'.format(now, zcatalog_id))
-        catalog = zcatalog._catalog
-        # optimize paths, uids, data - skip data for portal_catalog
-        combined += optimize(catalog, no_data=zcatalog_id == "portal_catalog")
-        # optimize lexica
-        for obj in zcatalog.values():
-            if isinstance(obj, Lexicon):
-                combined += optimize(obj)
-        # optimize indexes
-        for index in catalog.indexes.values():
-            if isinstance(index, ZCTextIndex):
-                combined += optimize(index.index)
-            else:
-                combined += optimize(index)
-    print('Optimized away {} buckets for site "{}"'.format(combined, site_id))
+        print('{} - Starting for site "{}" ...'.format(now, site_id))
+        combined = 0
+        site_report = report[site_id] = {}
+        for zcatalog in site.values():
+            if not isinstance(zcatalog, ZCatalog):
+                continue
+            zcatalog_id = zcatalog.getId()
+            now = datetime.now().isoformat()
+            if options.report:
+                print('{} - Analyzing "{}"'.format(now, zcatalog_id))
+                catalog_report = site_report[zcatalog_id] = {}
+                for name, obj, no_data in catalog_objects(zcatalog):
+                    result, catalog_report[name] = analyze(obj, no_data=no_data)
+                    combined += result
+                continue
+            if options.workers:
+                tasks.extend(catalog_tasks(site_id, zcatalog))
+                continue
+            print('{} - Optimizing "{}"'.format(now, zcatalog_id))
+            for name, obj, no_data in catalog_objects(zcatalog):
+                prefix = "/".join((site_id, zcatalog_id, name))
+                start = dict(footprint)
+                combined += optimize(obj, no_data=no_data, prefix=prefix)
+                add_footprint(prefix, footprint_since(start))
+        if options.report:
+            print(
+                'Optimizing would save {} buckets for site "{}"'.format(
+                    combined, site_id
+                )
+            )
+        elif not options.workers:
+            print('Optimized away {} buckets for site "{}"'.format(combined, site_id))
+
+    if tasks:
+        now = datetime.now().isoformat()
+        print(
+            "{} - Optimizing {} catalog parts in {} workers".format(
+                now, len(tasks), options.workers
+            )
+        )
+        # Load the helpers for the workers from sitejobs.py next to this script.
+        here = os.path.dirname(os.path.abspath(sys.argv[2]))
+        sitejobs = runpy.run_path(
+            os.path.join(here, "sitejobs.py"), run_name="sitejobs"
+        )
+        for site_id, combined in sorted(run_workers(tasks).items()):
+            print('Optimized away {} buckets for site "{}"'.format(combined, site_id))
+        # run_workers has closed our database, so open it again.
+        app = sitejobs["open_app"]()
+
+    if options.probe:
+        if not options.report:
+            probe_all("after")
+        print_probes()
+        with open(options.probe, "w") as probe_file:
+            json.dump(probes, probe_file, indent=2, sort_keys=True)
+        print("Wrote query probe to %s" % options.probe)
 
-print("%s - Finishing..." % datetime.now().isoformat())
-transaction.commit()
+    print_tree_summary()
+    if not options.report:
+        print_footprints()
+    print("%s - Finishing..." % datetime.now().isoformat())
+    if options.report:
+        transaction.abort()
+        with open(options.report, "w") as report_file:
+            json.dump(report, report_file, indent=2, sort_keys=True)
+        print("Wrote report to %s" % options.report)
+    else:
+        transaction.commit()
@@ -5,10 +5,13 @@
 #
 # For updates and more such scripts, see https://github.com/zestsoftware/plonescripts
 from plone.app.redirector.interfaces import IRedirectionStorage
+from Products.CMFCore.utils import getToolByName
 from zope.component import getUtility
 from zope.component.hooks import setSite
 
 import argparse
+import os
+import runpy
 import sys
 import transaction
 
@@ -20,6 +23,17 @@ parser.add_argument(
     dest="fix",
     help="Fix. Remove useless or not working redirects.",
 )
+parser.add_argument(
+    "--flatten",
+    action="store_true",
+    default=False,
+    dest="flatten",
+    help=(
+        "Flatten. Let each redirect point straight to the live target at the end "
+        "of its chain of redirects, and report cycles and chains that end in "
+        "a path that does not exist."
+    ),
+)
 parser.add_argument(
     "--verbose",
     action="store_true",
@@ -27,6 +41,16 @@ parser.add_argument(
     dest="verbose",
     help="Verbose. Prints all non-existing paths.",
 )
+parser.add_argument(
+    "--jobs",
+    default=1,
+    type=int,
+    dest="jobs",
+    help=(
+        "Handle this many Plone Sites at the same time, each in a worker process "
+        "with its own database connection. This needs ZEO."
+    ),
+)
 parser.add_argument(
     "--site",
     default="",
@@ -64,7 +88,135 @@ def commit(note):
     transaction.commit()
 
 
-for site in plones:
+def path_exists(path, catalog_paths, counts):
+    # Check the paths of the catalog first, and traverse when it does not know.
+    if path in catalog_paths:
+        counts["catalog"] += 1
+        return True
+    counts["traversal"] += 1
+    return app.unrestrictedTraverse(path, None) is not None
+
+
+def get_new_path(new_info):
+    # Since Plone 5.2 the new path is stored in a tuple with the date
+    # and a manual flag.
+    if isinstance(new_info, tuple):
+        return new_info[0]
+    return new_info
+
+
+def resolve_chains(paths, exists):
+    # Follow each redirect in paths (source -> target) to the end of its chain:
+    # the first target that exists, or that is not redirected itself.
+    # Return a dict with (final target, number of redirects, live) for each
+    # source, and a list of cycles.  Live is True when the final target exists.
+    # For a cycle the final target is None.
+    resolved = {}
+    cycles = []
+    for source in paths:
+        if source in resolved:
+            continue
+        walk = [source]
+        on_walk = {source: 0}
+        target = paths[source]
+        while True:
+            if exists(target):
+                final, hops, live = target, 0, True
+                break
+            if target not in paths:
+                # A dead end.
+                final, hops, live = target, 0, False
+                break
+            if target in on_walk:
+                cycles.append(walk[on_walk[target] :])
+                final, hops, live = None, 0, False
+                break
+            if target in resolved:
+                final, hops, live = resolved[target]
+                break
+            on_walk[target] = len(walk)
+            walk.append(target)
+            target = paths[target]
+        for number, path in enumerate(reversed(walk), 1):
+            resolved[path] = (final, hops + number, live)
+    return resolved, cycles
+
+
+def print_chain_lengths(resolved, when):
+    lengths = {}
+    for final, hops, live in resolved.values():
+        if live:
+            lengths[hops] = lengths.get(hops, 0) + 1
+    print(
+        "Lengths of chains to a live target {0}: {1}".format(
+            when,
+            ", ".join(
+                [
+                    "length {0}: {1}".format(hops, lengths[hops])
+                    for hops in sorted(lengths)
+                ]
+            ),
+        )
+    )
+
+
+def flatten_redirects(storage, catalog_paths):
+    # Let each redirect point to the end of its chain.  Returns the number
+    # of changed redirects.
+    paths = dict(
+        [(source, get_new_path(info)) for (source, info) in storage._paths.items()]
+    )
+    counts = {"catalog": 0, "traversal": 0}
+    existing = {}
+
+    def exists(path):
+        if path not in existing:
+            existing[path] = path_exists(path, catalog_paths, counts)
+        return existing[path]
+
+    resolved, cycles = resolve_chains(paths, exists)
+    print_chain_lengths(resolved, "before flattening")
+    print("Found {0} cycles.".format(len(cycles)))
+    for cycle in cycles:
+        print("Cycle: {0}".format(" -> ".join(cycle + [cycle[0]])))
+    # Leave chains that end in a path that does not exist alone:
+    # pointing straight to a dead end does not help anyone.
+    dead = [
+        (source, final)
+        for (source, (final, hops, live)) in resolved.items()
+        if final is not None and not live and hops > 1
+    ]
+    print(
+        "Found {0} chains that end in a path that does not exist, "
+        "not flattening these.".format(len(dead))
+    )
+    if options.verbose:
+        for source, final in sorted(dead):
+            print("Dead end: {0} -> ... -> {1}".format(source, final))
+    changed = 0
+    for source, (final, hops, live) in resolved.items():
+        if not live or final == paths[source]:
+            continue
+        if options.verbose:
+            print("Flattening: {0} -> {1} to {2}".format(source, paths[source], final))
+        info = storage._paths[source]
+        if isinstance(info, tuple):
+            storage._paths[source] = (final,) + info[1:]
+        else:
+            storage._paths[source] = final
+        paths[source] = final
+        changed += 1
+    if changed:
+        # Update the reverse paths.
+        storage._rebuild()
+    resolved, cycles = resolve_chains(paths, exists)
+    print_chain_lengths(resolved, "after flattening")
+    print("Flattened {0} redirects.".format(changed))
+    return changed
+
+
+def handle_site(site):
+    # Handle one Plone Site, and return a note for the summary.
     print("")
     print("Handling Plone Site %s." % site.id)
     setSite(site)
@@ -73,38 +225,61 @@ for site in plones:
     print(
         "There are {0} targets (reverse redirects)".format(len(storage._rpaths.keys()))
     )
+    # Most targets are cataloged, so get the cataloged paths once,
+    # and only traverse to the others, like non-cataloged objects or views.
+    catalog = getToolByName(site, "portal_catalog")
+    catalog_paths = set(catalog._catalog.uids.keys())
+    flattened = ""
+    if options.flatten:
+        changed = flatten_redirects(storage, catalog_paths)
+        if changed:
+            flattened = "Flattened {0} redirects. ".format(changed)
+            commit("Flattened {0} redirects for site {1}.".format(changed, site.id))
     print(
         "Looking for targets that do *not* exist, so that a redirect would give a 404 NotFound..."
     )
+    counts = {"catalog": 0, "traversal": 0}
     bad_rpaths = []
     for key in storage._rpaths.keys():
-        if app.unrestrictedTraverse(key, None) is not None:
+        if path_exists(key, catalog_paths, counts):
             continue
         bad_rpaths.append(key)
         if options.verbose:
             sources = storage.redirects(key)
             print("Non-existing target: {0} <- {1}".format(key, sources))
     print("Found {0} targets that do not exist.".format(len(bad_rpaths)))
+    print(
+        "Answered by the catalog: {0}, by traversing: {1}.".format(
+            counts["catalog"], counts["traversal"]
+        )
+    )
     print(
         "Looking for sources of redirects that *do* exist, so that the redirect is inactive..."
     )
+    # Here we always traverse: the catalog could still have an item that was
+    # moved away, and then we would remove a redirect that is needed.
+    counts = {"catalog": 0, "traversal": 0}
     bad_paths = []
     for key in storage._paths.keys():
-        if app.unrestrictedTraverse(key, None) is None:
+        if not path_exists(key, (), counts):
             continue
         bad_paths.append(key)
         if options.verbose:
             target = storage.get(key)
             print("Existing source: {0} -> {1}".format(key, target))
     print("Found {0} sources that do exist.".format(len(bad_paths)))
+    print("Answered by traversing: {0}.".format(counts["traversal"]))
+    del catalog_paths
     if not (bad_rpaths or bad_paths):
         print("No fixes are needed.")
         # Abort the transaction so we can start a new one.
         transaction.abort()
-        continue
+        return flattened + "No fixes are needed."
     if not options.fix:
         print("Option --fix not selected, so not fixing anything.")
-        continue
+        return flattened + "Found {0} non-existing redirect targets and {1} existing redirect sources.".format(
+            len(bad_rpaths), len(bad_paths)
+        )
     print("Fixing...")
     for key in bad_rpaths:
         storage.destroy(key)
@@ -118,3 +293,19 @@ for site in plones:
     )
     commit(note)
     print("Done.")
+    return flattened + note
+
+
+if options.jobs > 1:
+    # Load the helpers for --jobs from sitejobs.py next to this script.
+    here = os.path.dirname(os.path.abspath(sys.argv[2]))
+    sitejobs = runpy.run_path(os.path.join(here, "sitejobs.py"), run_name="sitejobs")
+    notes = sitejobs["run_site_jobs"](
+        app, [site.id for site in plones], handle_site, options.jobs, globals()
+    )
+else:
+    notes = [(site.id, handle_site(site)) for site in plones]
+print("")
+print("Summary:")
+for site_id, note in sorted(notes):
+    print("%s: %s" % (site_id, note))
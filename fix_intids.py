@@ -4,6 +4,7 @@
 # For background on the stranger parts of this script, see
 # https://github.com/plone/five.intid/issues/9#issuecomment-802940554
 
+from datetime import timedelta
 from plone import api
 from plone.uuid.interfaces import IUUID
 from Products.GenericSetup.tool import UNKNOWN
@@ -12,7 +13,10 @@ from zope.component.hooks import setSite
 from zope.intid.interfaces import IIntIds
 
 import argparse
+import os
+import runpy
 import sys
+import time
 import transaction
 
 parser = argparse.ArgumentParser()
@@ -34,6 +38,48 @@ parser.add_argument(
         "Regardless of command line options, we always repopulate when we see it is needed."
     ),
 )
+parser.add_argument(
+    "--no-catalog-paths",
+    action="store_false",
+    default=True,
+    dest="catalog_paths",
+    help=(
+        "Do not trust the paths in the portal_catalog when checking for broken paths. "
+        "By default we do, so we only need to traverse to paths that are not cataloged."
+    ),
+)
+parser.add_argument(
+    "--by-path",
+    action="store_true",
+    default=False,
+    dest="by_path",
+    help=(
+        "Only check content whose path in the catalog has no intid key. "
+        "This does not load the other content, so it is much faster, "
+        "but it does not notice when the object at a path has been replaced."
+    ),
+)
+parser.add_argument(
+    "--batch-size",
+    default=0,
+    type=int,
+    dest="batch_size",
+    help=(
+        "Commit after registering this many intids, or take a savepoint in a dry run. "
+        "Also garbage collect the cache and report progress after this many items. "
+        "Default 0: commit once per site."
+    ),
+)
+parser.add_argument(
+    "--jobs",
+    default=1,
+    type=int,
+    dest="jobs",
+    help=(
+        "Handle this many Plone Sites at the same time, each in a worker process "
+        "with its own database connection. This needs ZEO."
+    ),
+)
 parser.add_argument(
     "--site",
     default="",
@@ -74,24 +120,248 @@ def commit(note):
     transaction.commit()
 
 
-def actual_path(persistentkey):
+def get_uid_paths(catalog):
+    # Map the UID of all cataloged content to its path.  This uses the UID index
+    # (UID to document id) and the paths of the catalog (document id to path),
+    # so we do not need a catalog query and an object load for each key.
+    paths = catalog._catalog.paths
+    uid_paths = {}
+    for uuid, docid in catalog.Indexes["UID"]._index.items():
+        path = paths.get(docid)
+        if path is not None:
+            uid_paths[uuid] = path
+    return uid_paths
+
+
+def actual_path(persistentkey, uid_paths):
     # obj.UID() would return the UID of the parent in case obj is a Discussion Item.
     # With IUUID we do get the uuid of the comment itself.
     uuid = IUUID(persistentkey.object)
-    obj = api.content.get(UID=uuid)
-    try:
-        return "/".join(obj.getPhysicalPath())
-    except Exception:
-        pass
+    return uid_paths.get(uuid)
+
+
+def commit_batch(note):
+    # Commit a batch, or take a savepoint in a dry run,
+    # so the changed objects can be removed from the cache.
+    if options.dry_run:
+        transaction.savepoint(optimistic=True)
+        return
+    commit(note)
+
+
+def log_progress(done, total, start):
+    elapsed = time.time() - start
+    rate = done / elapsed if elapsed else 0
+    eta = (total - done) / rate if rate else 0
+    print(
+        "Checked %d out of %d items, %.1f per second, ETA %s." %
+        (done, total, rate, timedelta(seconds=int(eta)))
+    )
+
+
+def get_uncovered_brains(catalog, intids):
+    # Compare the paths of the intid keys with the paths in the catalog,
+    # without loading any content object.  Return the brains of the paths
+    # that have no intid key: the content may have no intid,
+    # or an intid that points to another path.
+    covered = set(key.path for key in intids.ids.keys())
+    _catalog = catalog._catalog
+    docids = []
+    count = 0
+    for docid, path in _catalog.paths.items():
+        count += 1
+        if path not in covered:
+            docids.append(docid)
+    print("%d out of %d catalog paths have no intid key." % (len(docids), count))
+    return [_catalog[docid] for docid in docids]
+
+
+# Counts of checked paths in the current site.
+path_stats = {"cached": 0, "traversed": 0}
+
+
+def split_path(path):
+    return [segment for segment in path.split("/") if segment]
+
+
+def add_path(trie, path, exists=True):
+    # The trie has a node for each path segment: a dict with the child
+    # segments, and under None whether the path exists, when we know it.
+    node = trie
+    for segment in split_path(path):
+        node = node.setdefault(segment, {})
+        if exists:
+            # When a path exists, all its parents exist too.
+            node[None] = True
+    if not exists:
+        # The whole subtree is missing, so forget about it.
+        node.clear()
+        node[None] = False
+
+
+def path_exists(trie, path):
+    # Check if the path exists, traversing only when the trie does not know.
+    node = trie
+    for segment in split_path(path):
+        node = node.get(segment)
+        if node is None:
+            break
+        if node.get(None) is False:
+            # A parent is missing, or the path itself.
+            path_stats["cached"] += 1
+            return False
+    else:
+        if node.get(None) is not None:
+            path_stats["cached"] += 1
+            return node[None]
+    segments = split_path(path)
+    if len(segments) > 1 and not path_exists(trie, "/" + "/".join(segments[:-1])):
+        # The parent is missing now, so the path is missing too.
+        return False
+    path_stats["traversed"] += 1
+    exists = app.unrestrictedTraverse(path, None) is not None  # noqa
+    add_path(trie, path, exists)
+    return exists
+
+
+def sort_ids(intid_refs):
+    # Turn the (intid, key) items of the refs into (key, intid) items for the ids,
+    # sorted by key.  Equal keys end up next to each other, so we check that they
+    # are unique while we are at it.  Like inserting them one by one would do,
+    # the last one wins: the highest intid.
+    intid_ids = []
+    duplicates = 0
+    for key, uid in sorted(
+        [(key, uid) for (uid, key) in intid_refs], key=lambda item: item[0]
+    ):
+        if intid_ids and intid_ids[-1][0] == key:
+            intid_ids[-1] = (key, uid)
+            duplicates += 1
+        else:
+            intid_ids.append((key, uid))
+    return intid_ids, duplicates
+
+
+def node_state(children):
+    # (child0, key1, child1, key2, child2, ...)
+    state = [children[0][1]]
+    for key, child, firstbucket in children[1:]:
+        state.append(key)
+        state.append(child)
+    return tuple(state)
 
 
-def remove_refs_missing_from_ids(intids):
+def bulk_load(tree, items, fill=0.9):
+    # Load sorted (key, value) items into an empty tree, with buckets that are
+    # filled for 90 percent.  Inserting them one by one leaves buckets half empty,
+    # because a full bucket is split in two.  See also catalogoptimize.py.
+    klass = tree.__class__
+    max_leaf_size = getattr(klass, "max_leaf_size", None)
+    if max_leaf_size is None or len(items) <= max_leaf_size:
+        # Older BTrees versions, or only one bucket.
+        tree.update(items)
+        return
+    bucket_size = max(1, int(max_leaf_size * fill))
+    # Create the buckets from last to first, so we can link each bucket
+    # to its next one.  children is a list of (first key, node, first bucket).
+    children = []
+    next_bucket = None
+    for start in reversed(range(0, len(items), bucket_size)):
+        chunk = items[start : start + bucket_size]
+        bucket = klass._bucket_type()
+        flat = tuple([part for item in chunk for part in item])
+        if next_bucket is None:
+            bucket.__setstate__((flat,))
+        else:
+            bucket.__setstate__((flat, next_bucket))
+        children.append((chunk[0][0], bucket, bucket))
+        next_bucket = bucket
+    children.reverse()
+    # Stack full internal nodes on top of the buckets until one root is left.
+    max_internal_size = getattr(klass, "max_internal_size", 250)
+    while len(children) > max_internal_size:
+        parents = []
+        for start in range(0, len(children), max_internal_size):
+            group = children[start : start + max_internal_size]
+            node = klass()
+            node.__setstate__((node_state(group), group[0][2]))
+            parents.append((group[0][0], node, group[0][2]))
+        children = parents
+    tree.__setstate__((node_state(children), children[0][2]))
+    tree._p_changed = True
+
+
+def scan_intids(intids, site, trie, check_unique=True):
     # The intids catalog has two BTrees:
     # - ids: mapping from key reference to intid
     # - refs: mapping from intid to key reference
-    refs_missing_from_ids = [
-        (uid, key) for (uid, key) in intids.refs.items() if key not in intids.ids
-    ]
+    # They should be a mirror of each other.
+    # Go over both BTrees once, and sort the items into all problem categories,
+    # so we do not load all key references again for each check.
+    scan = {
+        "count": 0,
+        "unique": 0,
+        "missing": 0,
+        "broken_path": [],
+        "outside_site": [],
+        "refs_missing_from_ids": [],
+        "ids_missing_from_refs": [],
+    }
+    site_path = "/%s" % site.id
+    seen = set()
+    for key, uid in intids.ids.items():
+        scan["count"] += 1
+        # All keys should be unique, otherwise we run into errors,
+        # which might need a fix in the __hash__ method in five.intid.
+        if check_unique:
+            seen.add(key)
+        if key not in intids.ids:
+            # This sounds weird, but may happen when the hash method changes.
+            scan["missing"] += 1
+        if intids.refs.get(uid) != key:
+            # The refs have another key for this intid, or none at all.
+            scan["ids_missing_from_refs"].append((key, uid))
+            continue
+        if not key.path:
+            continue
+        if not path_exists(trie, key.path):
+            scan["broken_path"].append(key)
+        elif not key.path.startswith(site_path):
+            scan["outside_site"].append(key)
+    if check_unique:
+        scan["unique"] = len(seen)
+    else:
+        scan["unique"] = scan["count"]
+    del seen
+    for uid, key in intids.refs.items():
+        if intids.ids.get(key) != uid:
+            # The ids have another intid for this key, or none at all.
+            scan["refs_missing_from_ids"].append((uid, key))
+    return scan
+
+
+def check_keys(scan, error=False):
+    # Report missing and duplicate keys.  Return True when all is well.
+    if error:
+        prefix = "ERROR: "
+        suffix = " This is after rebuilding the BTrees, so something is wrong."
+    else:
+        prefix = suffix = ""
+    if scan["missing"]:
+        print(
+            "%s%d keys from intids.ids are missing from intid.ids. "
+            "This sounds weird, but may happen when the hash method changes.%s" %
+            (prefix, scan["missing"], suffix)
+        )
+    if scan["unique"] != scan["count"]:
+        print(
+            "%sOnly %d out of %d keys are unique.%s" %
+            (prefix, scan["unique"], scan["count"], suffix)
+        )
+    return not scan["missing"] and scan["unique"] == scan["count"]
+
+
+def remove_refs_missing_from_ids(intids, refs_missing_from_ids):
     print(
         "Found %d intid references that are missing from the ids." % len(refs_missing_from_ids)
     )
@@ -104,10 +374,7 @@ def remove_refs_missing_from_ids(intids):
     return len(refs_missing_from_ids)
 
 
-def remove_ids_missing_from_refs(intids):
-    ids_missing_from_refs = [
-        (key, uid) for (key, uid) in intids.ids.items() if uid not in intids.refs
-    ]
+def remove_ids_missing_from_refs(intids, ids_missing_from_refs):
     print(
         "Found %d intid ids that are missing from the refs." % len(ids_missing_from_refs)
     )
@@ -120,12 +387,19 @@ def remove_ids_missing_from_refs(intids):
     return len(ids_missing_from_refs)
 
 
-for site in plones:
+def handle_site(site):
+    # Handle one Plone Site, and return a note for the summary.
     print("")
     print("Handling Plone Site %s." % site.id)
     setSite(site)
     catalog = api.portal.get_tool(name="portal_catalog")
     intids = getUtility(IIntIds)
+    # Remember which paths exist, so we traverse each path at most once.
+    trie = {}
+    path_stats.update(cached=0, traversed=0)
+    if options.catalog_paths:
+        for path in catalog._catalog.paths.values():
+            add_path(trie, path)
 
     # First things first.  There might have been subtle changes to the
     # __hash__ method of key references, and this is not good when they are
@@ -133,21 +407,14 @@ for site in plones:
     # See https://docs.python.org/3.8/glossary.html#term-hashable
     # and https://docs.python.org/3.8/reference/datamodel.html#object.__hash__
     # So we may need to repopulate the BTrees.
+    # When we repopulate anyway, we only need to scan the result.
     repopulated = False
-    id_keys_missing_from_id = [key for key in intids.ids if key not in intids.ids]
-    if id_keys_missing_from_id:
-        print(
-            "%s keys from intids.ids are missing from intid.ids. "
-            "This sounds weird, but may happen when the hash method changes." %
-            len(id_keys_missing_from_id)
-        )
-    # All keys should be unique, otherwise we run into errors,
-    # which might need a fix in the __hash__ method in five.intid.
-    keys = list(intids.ids.keys())
-    all_unique = len(keys) == len(set(keys))
-    if not all_unique:
-        print("Only %d out of %d keys are unique." % (len(set(keys)), len(keys)))
-    if options.repopulate or id_keys_missing_from_id or not all_unique:
+    if options.repopulate:
+        scan = None
+    else:
+        print("Scanning intids.")
+        scan = scan_intids(intids, site, trie)
+    if scan is None or not check_keys(scan):
         print("Repopulating BTrees.")
         repopulated = True
         # The refs and ids should be a mirror of each other.
@@ -155,49 +422,50 @@ for site in plones:
         # so let's take the refs as the original and rebuild from there.
         # Note: we take the refs as base, because their keys are simple integers,
         # which means it is less likely that something is broken in the refs.
+        # The refs are sorted by intid already.  Sort the ids by key once,
+        # and load both BTrees in one go, instead of inserting the ids
+        # in the random order of the intids.
         intid_refs = list(intids.refs.items())
+        intid_ids, duplicates = sort_ids(intid_refs)
+        if duplicates:
+            print(
+                "Only %d out of %d keys are unique.  "
+                "Keeping the highest intid for each key." %
+                (len(intid_ids), len(intid_refs))
+            )
         intids.ids.clear()
         intids.refs.clear()
-        for key, value in intid_refs:
-            intids.refs[key] = value
-            intids.ids[value] = key
+        bulk_load(intids.refs, intid_refs)
+        bulk_load(intids.ids, intid_ids)
+        del intid_refs
+        del intid_ids
         print("Done repopulating BTrees.")
-        # We check again.
-        id_keys_missing_from_id = [key for key in intids.ids if key not in intids.ids]
-        if id_keys_missing_from_id:
-            print(
-                "ERROR: %d keys from intids.ids are missing from intid.ids. "
-                "This is after rebuilding the BTrees, so something is wrong." %
-                len(id_keys_missing_from_id)
-            )
-            sys.exit(1)
-        keys = list(intids.ids.keys())
-        all_unique = len(keys) == len(set(keys))
-        if not all_unique:
-            print(
-                "ERROR: Only %d out of %d keys are unique. "
-                "This is after rebuilding the BTrees, so something is wrong." %
-                (len(set(keys)), len(keys))
-            )
+        # We check again.  The sort has made the keys unique.
+        print("Scanning intids.")
+        scan = scan_intids(intids, site, trie, check_unique=False)
+        if not check_keys(scan, error=True):
             sys.exit(1)
 
+    print(
+        "Checked paths: %d found in cache, %d traversed." %
+        (path_stats["cached"], path_stats["traversed"])
+    )
+
     # Look for keys with a broken path.  Fix them.
-    keys_with_a_broken_path = [
-        key
-        for key in intids.ids
-        if key.path and not app.unrestrictedTraverse(key.path, None)
-    ]
-    print("%d keys with broken path" % len(keys_with_a_broken_path))
+    print("%d keys with broken path" % len(scan["broken_path"]))
     # Some can be fixed, some need to be removed.
     fixed_broken = 0
     removed_broken = 0
-    for key in keys_with_a_broken_path:
+    if scan["broken_path"]:
+        uid_paths = get_uid_paths(catalog)
+        print("Found paths of %d UIDs in the catalog." % len(uid_paths))
+    for key in scan["broken_path"]:
         # Remove the item.
         uid = intids.ids[key]
         del intids.refs[uid]
         del intids.ids[key]
         # Maybe we can find a good path.
-        proper_path = actual_path(key)
+        proper_path = actual_path(key, uid_paths)
         if proper_path:
             # This fixes lots of keys to objects that have been moved.
             # Setting key.path is not enough: the change is not persisted.
@@ -219,13 +487,10 @@ for site in plones:
     )
 
     # Look for keys with a path outside of the site.  Remove these.
-    keys_with_path_outside_of_site = [
-        key for key in intids.ids if key.path and not key.path.startswith("/%s" % site.id)
-    ]
-    print("%d keys with path outside of site" % len(keys_with_path_outside_of_site))
+    print("%d keys with path outside of site" % len(scan["outside_site"]))
 
     removed_outside = 0
-    for key in keys_with_path_outside_of_site:
+    for key in scan["outside_site"]:
         uid = intids.ids[key]
         del intids.refs[uid]
         del intids.ids[key]
@@ -237,26 +502,72 @@ for site in plones:
     # otherwise they may not entirely be in sync:
     # - The same object has one intid in the ids and another in the refs.
     # - The same intid has a different object in ids and refs.
-    # Check this, and remove inconsistent items, getting back a count.
-    refs_missing_from_ids = remove_refs_missing_from_ids(intids)
-    ids_missing_from_refs = remove_ids_missing_from_refs(intids)
-    # It seems needed to run both twice.
-    refs_missing_from_ids += remove_refs_missing_from_ids(intids)
-    ids_missing_from_refs += remove_ids_missing_from_refs(intids)
+    # The scan has checked each item against its mirror item,
+    # so removing the inconsistent items once is enough, getting back a count.
+    refs_missing_from_ids = remove_refs_missing_from_ids(
+        intids, scan["refs_missing_from_ids"]
+    )
+    ids_missing_from_refs = remove_ids_missing_from_refs(
+        intids, scan["ids_missing_from_refs"]
+    )
+    del scan
+
+    if options.batch_size and (
+        repopulated
+        or fixed_broken
+        or removed_broken
+        or removed_outside
+        or refs_missing_from_ids
+        or ids_missing_from_refs
+    ):
+        # Commit the repairs with their own note, otherwise they end up
+        # in the first batch of registrations.
+        commit_batch(
+            "Repaired intids for %s: "
+            "repopulated BTrees: %d, "
+            "fixed %d keys with broken paths, "
+            "removed %d keys with broken paths, "
+            "removed %d keys with path outside of site, "
+            "removed %d refs missing from ids, "
+            "removed %d ids missing from refs."
+            % (
+                site.id,
+                repopulated,
+                fixed_broken,
+                removed_broken,
+                removed_outside,
+                refs_missing_from_ids,
+                ids_missing_from_refs,
+            )
+        )
 
     # The above fixes should be enough to fix all inconsistencies.
     # But there might still be objects without an intid.
     # Registering them was the initial purpose of this script.
     # So go through all content.
     fixed_intid = 0
-    brains = list(catalog.getAllBrains())
+    if options.by_path:
+        brains = get_uncovered_brains(catalog, intids)
+    else:
+        brains = list(catalog.getAllBrains())
     print("Found %d  brains." % len(brains))
     # We need to know if multilingual is installed.
     setup_tool = api.portal.get_tool(name="portal_setup")
     is_multilingual = setup_tool.getLastVersionForProfile(
         "plone.app.multilingual:default"
     ) != UNKNOWN
-    for brain in brains:
+    start = time.time()
+    batched = 0
+    for done, brain in enumerate(brains):
+        if options.batch_size and fixed_intid - batched >= options.batch_size:
+            commit_batch(
+                "Fixed intids for %s: registered %d new intids so far." %
+                (site.id, fixed_intid)
+            )
+            batched = fixed_intid
+        if options.batch_size and done and done % options.batch_size == 0:
+            site._p_jar.cacheGC()
+            log_progress(done, len(brains), start)
         # Note: I had one Plone 6 site where Discussion Items (comments)
         # had no intid, but this seems to have been an error.
         try:
@@ -305,7 +616,7 @@ for site in plones:
         print("No fixes were done.")
         # Abort the transaction so we can start a new one.
         transaction.abort()
-        continue
+        return "No fixes were done."
     note = (
         "Fixed intids for %s: "
         "repopulated BTrees: %d, "
@@ -328,3 +639,19 @@ for site in plones:
     )
     commit(note)
     print("Done.")
+    return note
+
+
+if options.jobs > 1:
+    # Load the helpers for --jobs from sitejobs.py next to this script.
+    here = os.path.dirname(os.path.abspath(sys.argv[2]))
+    sitejobs = runpy.run_path(os.path.join(here, "sitejobs.py"), run_name="sitejobs")
+    notes = sitejobs["run_site_jobs"](
+        app, [site.id for site in plones], handle_site, options.jobs, globals()
+    )
+else:
+    notes = [(site.id, handle_site(site)) for site in plones]
+print("")
+print("Summary:")
+for site_id, note in sorted(notes):
+    print("%s: %s" % (site_id, note))
@@ -15,8 +15,12 @@
 # Tested on Plone 5.2.
 
 import argparse
+import os
+import runpy
 import sys
 import transaction
+from BTrees import IIBTree
+from BTrees import OOBTree
 from plone import api
 from plone.app.redirector.interfaces import IRedirectionStorage
 from plone.uuid.handlers import addAttributeUUID
@@ -36,6 +40,27 @@ parser.add_argument(
     dest="dry_run",
     help="Dry run. No changes will be saved.",
 )
+parser.add_argument(
+    "--incremental",
+    action="store_true",
+    default=False,
+    dest="incremental",
+    help=(
+        "Only patch the inconsistent entries of the UID index, "
+        "instead of clearing and reindexing it. "
+        "When the index is still inconsistent after that, we reindex it anyway."
+    ),
+)
+parser.add_argument(
+    "--jobs",
+    default=1,
+    type=int,
+    dest="jobs",
+    help=(
+        "Handle this many Plone Sites at the same time, each in a worker process "
+        "with its own database connection. This needs ZEO."
+    ),
+)
 parser.add_argument(
     "--site",
     default="",
@@ -76,7 +101,149 @@ def commit(note):
     transaction.commit()
 
 
-for site in plones:
+def is_contained(parent, id):
+    # Is there an item with this id in the parent, without acquisition?
+    # This does not load the item itself.
+    try:
+        return parent.hasObject(id)
+    except AttributeError:
+        return False
+
+
+def get_container(containers, segments):
+    # Get the container at the path with these segments, or None.
+    # Containers are cached per path prefix.
+    prefix = "/".join(segments)
+    if prefix in containers:
+        return containers[prefix]
+    parent = get_container(containers, segments[:-1])
+    container = None
+    if parent is not None and is_contained(parent, segments[-1]):
+        container = parent._getOb(segments[-1], None)
+    containers[prefix] = container
+    return container
+
+
+def verify_paths(paths, batch_size=1000):
+    # Check that each item is really contained in its parent container,
+    # one path segment at a time.  This does not wake up the items themselves.
+    # Return the paths that we could not verify like this:
+    # missing items, items found by acquisition, or paths with a namespace
+    # like ++conversation++default.
+    containers = {"": app}
+    prefetch = getattr(app._p_jar, "prefetch", None)
+    unsure = []
+    for start in range(0, len(paths), batch_size):
+        batch = []
+        for path in paths[start : start + batch_size]:
+            if path.startswith("/") and len(path) > 1:
+                batch.append((path, path.split("/")[1:]))
+            else:
+                unsure.append(path)
+        if prefetch is not None:
+            # Load the parents that we do not have yet in one go,
+            # when we have their own parent already.
+            parents = []
+            for path, segments in batch:
+                prefix = "/".join(segments[:-1])
+                grandparent = containers.get("/".join(segments[:-2]))
+                if prefix in containers or grandparent is None:
+                    continue
+                if is_contained(grandparent, segments[-2]):
+                    parents.append(grandparent._getOb(segments[-2]))
+            if parents:
+                prefetch(parents)
+        for path, segments in batch:
+            parent = get_container(containers, segments[:-1])
+            if parent is None or not is_contained(parent, segments[-1]):
+                unsure.append(path)
+        print("Verified %d/%d paths..." % (min(start + batch_size, len(paths)), len(paths)))
+    return unsure
+
+
+def check_uid_index(index):
+    # Compare the _index (UID -> doc id) and the _unindex (doc id -> UID)
+    # of the UID index.  We put their keys and values in BTrees sets once,
+    # so looking up an item is fast, and the differences take linear time.
+    index_uids = OOBTree.OOTreeSet(index._index.keys())
+    index_docids = IIBTree.IITreeSet(index._index.values())
+    unindex_docids = IIBTree.IITreeSet(index._unindex.keys())
+    unindex_uids = OOBTree.OOTreeSet(index._unindex.values())
+    index_length = len(index._index)
+    unindex_length = len(index._unindex)
+    print(
+        "Number of _index uid keys:      %d, unique: %d" %
+        (index_length, len(index_uids))
+    )
+    print(
+        "Number of _index doc id values: %d, unique: %d" %
+        (index_length, len(index_docids))
+    )
+    print(
+        "Number of _unindex doc id keys: %d, unique: %d" %
+        (unindex_length, len(unindex_docids))
+    )
+    print(
+        "Number of _unindex uid values:  %d, unique: %d" %
+        (unindex_length, len(unindex_uids))
+    )
+    check = {
+        "uids_missing_from_index": OOBTree.difference(unindex_uids, index_uids),
+        "docids_missing_from_index": IIBTree.difference(unindex_docids, index_docids),
+        # Orphaned entries of the _index, pointing to doc ids that are not indexed.
+        "docids_missing_from_unindex": IIBTree.difference(index_docids, unindex_docids),
+        "uids_missing_from_unindex": OOBTree.difference(index_uids, unindex_uids),
+    }
+    consistent = len(IIBTree.intersection(index_docids, unindex_docids))
+    print(
+        "Doc ids in both _index and _unindex: %d, only in _unindex: %d, "
+        "only in _index: %d" %
+        (
+            consistent,
+            len(check["docids_missing_from_index"]),
+            len(check["docids_missing_from_unindex"]),
+        )
+    )
+    print(
+        "UIDs only in _unindex: %d, only in _index: %d" %
+        (
+            len(check["uids_missing_from_index"]),
+            len(check["uids_missing_from_unindex"]),
+        )
+    )
+    return check
+
+
+def is_consistent(check):
+    return not any(check.values())
+
+
+def repair_uid_index(index):
+    # Patch the inconsistent entries of the UID index in place,
+    # without touching any content object.  Return the number of patched entries.
+    patched = 0
+    # Remove _index entries that point to a doc id with another UID, or none.
+    for uid, docid in list(index._index.items()):
+        if index._unindex.get(docid) != uid:
+            print("Removing _index entry for UID %s and doc id %s" % (uid, docid))
+            del index._index[uid]
+            patched += 1
+    # Add _index entries for UIDs that are only in the _unindex.
+    # For a duplicate UID the first doc id wins.  The others stay inconsistent,
+    # so we fall back to a full reindex, like before.
+    for docid, uid in index._unindex.items():
+        if uid not in index._index:
+            print("Adding _index entry for UID %s and doc id %s" % (uid, docid))
+            index._index[uid] = docid
+            patched += 1
+    length = getattr(index, "_length", None)
+    if length is not None:
+        length.set(len(index._index))
+    return patched
+
+
+def handle_site(site):
+    # Handle one Plone Site, and return a note for the summary.
     print("")
     print("Handling Plone Site %s." % site.id)
     setSite(site)
@@ -87,8 +254,12 @@ for site in plones:
         "Checking for paths in the catalog UID index that do not exist "
         "or that lead to a different path..."
     )
-    total = len(actual_catalog.uids.keys())
-    for index, path in enumerate(actual_catalog.uids.keys(), 1):
+    # First check the paths segment by segment, which only loads containers.
+    # Check the rest the slow way, by traversing and waking up the object.
+    unsure_paths = verify_paths(list(actual_catalog.uids.keys()))
+    print("%d paths need to be checked by traversing." % len(unsure_paths))
+    total = len(unsure_paths)
+    for index, path in enumerate(unsure_paths, 1):
         if index and index % 1000 == 0:
             print("Checked %d/%d paths..." % (index, total))
         try:
@@ -121,28 +292,12 @@ for site in plones:
     index = catalog.Indexes["UID"]
     # _index: UID -> doc id
     # _unindex: doc id -> UID
-    _index_keys = index._index.keys()
-    _index_values = index._index.values()
-    _unindex_keys = index._unindex.keys()
-    _unindex_values = index._unindex.values()
-    print(
-        "Number of _index uid keys:      %d, unique: %d" %
-        (len(_index_keys), len(set(_index_keys)))
-    )
-    print(
-        "Number of _index doc id values: %d, unique: %d" %
-        (len(_index_values), len(set(_index_values)))
-    )
-    print(
-        "Number of _unindex doc id keys: %d, unique: %d" %
-        (len(_unindex_keys), len(set(_unindex_keys)))
-    )
-    print(
-        "Number of _unindex uid values:  %d, unique: %d" %
-        (len(_unindex_values), len(set(_unindex_values)))
-    )
+    check = check_uid_index(index)
     missing = 0
-    seen_uids = set()
+    # Map each UID to its first doc id, and each duplicate UID to all its doc ids,
+    # so we only need one pass over the _unindex.
+    first_docids = {}
+    duplicates = {}
     # Gather a list of paths for which we will create a new uuid.
     recreate = []
     # The _index and _unindex could be inconsistent in various ways.
@@ -150,14 +305,14 @@ for site in plones:
     # It depends on what the exact problem is in our site.
     # So we may do too many or too few checks here.  Let's see.
     for docid, uid in index._unindex.items():
-        if uid not in _index_keys:
+        if uid in check["uids_missing_from_index"]:
             # Note: I have not seen this.
             path = catalog.getpath(docid)
             print(
                 "UID %s is missing from _index keys. docid %s, path %s" %
                 (uid, docid, path))
             missing += 1
-        if docid not in _index_values:
+        if docid in check["docids_missing_from_index"]:
             # Note: this seems the main problem.
             path = catalog.getpath(docid)
             print(
@@ -166,35 +321,37 @@ for site in plones:
             )
             missing += 1
             recreate.append(path)
-        if uid in seen_uids:
-            # This probably only happens if docid is not in _index_values
-            # (see previous condition), but let's check and report separately.
-            print("UID %s is duplicate in the _unindex values:" % uid)
-            for (key, value) in index._unindex.items():
-                if value != uid:
-                    continue
-                path = catalog.getpath(key)
-                print("- doc id %s path %s" % (key, path))
-                try:
-                    obj = app.unrestrictedTraverse(path)
-                except KeyError:
-                    print("Ignoring unreachable path when checking duplicate UID: %s" % path)
-                    continue
-                try:
-                    intids.getId(obj)
-                except KeyError:
-                    intids.register(obj)
-                    fixed_intid += 1
-                    print("- Registered intid for object at path %s" % path)
+        if uid in first_docids:
+            duplicates.setdefault(uid, [first_docids[uid]]).append(docid)
         else:
-            seen_uids.add(uid)
+            first_docids[uid] = docid
+    del first_docids
+
+    # This probably only happens if a doc id is not in the _index values
+    # (see the previous checks), but let's check and report separately.
+    for uid, docids in duplicates.items():
+        print("UID %s is duplicate in the _unindex values:" % uid)
+        for docid in docids:
+            path = catalog.getpath(docid)
+            print("- doc id %s path %s" % (docid, path))
+            try:
+                obj = app.unrestrictedTraverse(path)
+            except KeyError:
+                print("Ignoring unreachable path when checking duplicate UID: %s" % path)
+                continue
+            try:
+                intids.getId(obj)
+            except KeyError:
+                intids.register(obj)
+                fixed_intid += 1
+                print("- Registered intid for object at path %s" % path)
 
     if not (missing or recreate or fixed_intid or uncatalog_paths):
         print(
             "No UIDs are missing or need to be recreated, and no intids were added, "
             "and no paths were uncataloged."
         )
-        continue
+        return "No fixes were needed."
 
     if recreate:
         print(
@@ -242,11 +399,23 @@ for site in plones:
             (old_uuid, new_uuid, path)
         )
 
-    # Even after the above fix, the clear and reindex is still needed.
-    print("Clearing UID index")
-    index.clear()
-    print("Reindexing UID index")
-    catalog._catalog.reindexIndex("UID", site.REQUEST)
+    patched = 0
+    reindexed = True
+    if options.incremental:
+        # The objects with a recreated UID have been reindexed already.
+        print("Patching UID index")
+        patched = repair_uid_index(index)
+        print("Patched %d entries, checking UID index again" % patched)
+        if is_consistent(check_uid_index(index)):
+            reindexed = False
+        else:
+            print("UID index is still inconsistent.")
+    if reindexed:
+        # Even after the above fix, the clear and reindex is still needed.
+        print("Clearing UID index")
+        index.clear()
+        print("Reindexing UID index")
+        catalog._catalog.reindexIndex("UID", site.REQUEST)
 
     if len(index._index) != len(index._unindex):
         print(
@@ -257,17 +426,88 @@ for site in plones:
         )
         print("ERROR: NOT COMMITTING ANYTHING.")
         # sys.exit(1)
-        continue
+        return "ERROR: the UID _index and _unindex differ after reindexing."
 
-    # On a hunch, let's rebuild the redirection storage.  Only takes a few seconds.
+    # On a hunch, let's check the redirection storage,
+    # and rebuild it when it is inconsistent.
+    redirects = ""
     try:
         storage = getUtility(IRedirectionStorage)
     except ComponentLookupError:
         # I have seen a site where the redirectionstorage was disabled.
         print("Redirection storage component not found, so not rebuilding.")
     else:
-        storage._rebuild()
-        print("Rebuilt redirection storage.")
+        checked, mismatches = check_redirection_storage(storage)
+        print(
+            "Checked %d redirection storage entries, found %d mismatches." %
+            (checked, mismatches)
+        )
+        if mismatches:
+            storage._rebuild()
+            print("Rebuilt redirection storage.")
+            redirects = (
+                ", checked %d redirection entries, found %d mismatches, "
+                "rebuilt redirection storage" % (checked, mismatches)
+            )
+        else:
+            redirects = ", checked %d redirection entries" % checked
 
     print("Committing...")
-    commit("Fixed inconsistencies in UID index for site %s." % site.id)
+    if reindexed:
+        note = "Fixed inconsistencies in UID index for site %s%s." % (
+            site.id,
+            redirects,
+        )
+    else:
+        note = (
+            "Fixed inconsistencies in UID index for site %s: "
+            "patched %d entries%s." % (site.id, patched, redirects)
+        )
+    commit(note)
+    return note
+
+
+def get_new_path(new_info):
+    # Since Plone 5.2 the new path is stored in a tuple with the date
+    # and a manual flag.
+    if isinstance(new_info, tuple):
+        return new_info[0]
+    return new_info
+
+
+def check_redirection_storage(storage):
+    # Check that _rpaths (new path -> old paths) is the reverse of
+    # _paths (old path -> new path).  This loads no content, only the BTrees.
+    # Return the number of checked entries and the number of mismatches.
+    checked = 0
+    mismatches = 0
+    for old_path, new_info in storage._paths.items():
+        checked += 1
+        old_paths = storage._rpaths.get(get_new_path(new_info))
+        if old_paths is None or old_path not in old_paths:
+            mismatches += 1
+    for new_path, old_paths in storage._rpaths.items():
+        if not old_paths:
+            # A rebuild removes this.
+            mismatches += 1
+        for old_path in old_paths:
+            checked += 1
+            new_info = storage._paths.get(old_path)
+            if new_info is None or get_new_path(new_info) != new_path:
+                mismatches += 1
+    return checked, mismatches
+
+
+if options.jobs > 1:
+    # Load the helpers for --jobs from sitejobs.py next to this script.
+    here = os.path.dirname(os.path.abspath(sys.argv[2]))
+    sitejobs = runpy.run_path(os.path.join(here, "sitejobs.py"), run_name="sitejobs")
+    notes = sitejobs["run_site_jobs"](
+        app, [site.id for site in plones], handle_site, options.jobs, globals()
+    )
+else:
+    notes = [(site.id, handle_site(site)) for site in plones]
+print("")
+print("Summary:")
+for site_id, note in sorted(notes):
+    print("%s: %s" % (site_id, note))
@@ -2,8 +2,11 @@
 # bin/instance run scripts/purge_image_scales.py
 #
 # Add --dry-run to change nothing and only get a report.
+# Add --jobs=4 to handle four Plone Sites at the same time.
 #
 # For updates and more such scripts, see https://github.com/zestsoftware/plonescripts
+import os
+import runpy
 import sys
 import transaction
 from Products.CMFCore.utils import getToolByName
@@ -15,6 +18,13 @@ DAYS = -1
 # Commit after these many changes:
 LIMIT = 1000
 
+# Handle this many Plone Sites at the same time, each in a worker process
+# with its own database connection.  This needs ZEO.
+jobs = 1
+for arg in sys.argv:
+    if arg.startswith("--jobs="):
+        jobs = int(arg[len("--jobs=") :])
+
 if "--dry-run" in sys.argv:
     dry_run = True
     print("Dry run selected, will not commit changes.")
@@ -38,7 +48,8 @@ def commit(note):
     transaction.commit()
 
 
-for site in plones:
+def handle_site(site):
+    # Handle one Plone Site, and return a note for the summary.
     print("")
     print("Handling Plone Site %s." % site.id)
     setSite(site)
@@ -94,5 +105,21 @@ for site in plones:
         "Plone Site %s." % (purged, count, site.id)
     )
     commit(note)
+    return note
+
+
+if jobs > 1:
+    # Load the helpers for --jobs from sitejobs.py next to this script.
+    here = os.path.dirname(os.path.abspath(sys.argv[2]))
+    sitejobs = runpy.run_path(os.path.join(here, "sitejobs.py"), run_name="sitejobs")
+    notes = sitejobs["run_site_jobs"](
+        app, [site.id for site in plones], handle_site, jobs, globals()
+    )
+else:
+    notes = [(site.id, handle_site(site)) for site in plones]
+print("")
+print("Summary:")
+for site_id, note in sorted(notes):
+    print("%s: %s" % (site_id, note))
 
 print("Done.")
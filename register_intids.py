@@ -3,13 +3,17 @@
 # or with extra options: --dry-run --site=plone
 #
 # For updates and more such scripts, see https://github.com/zestsoftware/plonescripts
+from datetime import timedelta
 from plone import api
 from zope.component import getUtility
 from zope.component.hooks import setSite
 from zope.intid.interfaces import IIntIds
 
 import argparse
+import os
+import runpy
 import sys
+import time
 import transaction
 
 parser = argparse.ArgumentParser()
@@ -20,6 +24,38 @@ parser.add_argument(
     dest="dry_run",
     help="Dry run. No changes will be saved.",
 )
+parser.add_argument(
+    "--by-path",
+    action="store_true",
+    default=False,
+    dest="by_path",
+    help=(
+        "Only check content whose path in the catalog has no intid key. "
+        "This does not load the other content, so it is much faster, "
+        "but it does not notice when the object at a path has been replaced."
+    ),
+)
+parser.add_argument(
+    "--batch-size",
+    default=0,
+    type=int,
+    dest="batch_size",
+    help=(
+        "Commit after registering this many intids, or take a savepoint in a dry run. "
+        "Also garbage collect the cache and report progress after this many items. "
+        "Default 0: commit once per site."
+    ),
+)
+parser.add_argument(
+    "--jobs",
+    default=1,
+    type=int,
+    dest="jobs",
+    help=(
+        "Handle this many Plone Sites at the same time, each in a worker process "
+        "with its own database connection. This needs ZEO."
+    ),
+)
 parser.add_argument(
     "--site",
     default="",
@@ -60,18 +96,70 @@ def commit(note):
     transaction.commit()
 
 
-for site in plones:
+def commit_batch(note):
+    # Commit a batch, or take a savepoint in a dry run,
+    # so the changed objects can be removed from the cache.
+    if options.dry_run:
+        transaction.savepoint(optimistic=True)
+        return
+    commit(note)
+
+
+def log_progress(done, total, start):
+    elapsed = time.time() - start
+    rate = done / elapsed if elapsed else 0
+    eta = (total - done) / rate if rate else 0
+    print(
+        "Checked %d out of %d items, %.1f per second, ETA %s." %
+        (done, total, rate, timedelta(seconds=int(eta)))
+    )
+
+
+def get_uncovered_brains(catalog, intids):
+    # Compare the paths of the intid keys with the paths in the catalog,
+    # without loading any content object.  Return the brains of the paths
+    # that have no intid key: the content may have no intid,
+    # or an intid that points to another path.
+    covered = set(key.path for key in intids.ids.keys())
+    _catalog = catalog._catalog
+    docids = []
+    count = 0
+    for docid, path in _catalog.paths.items():
+        count += 1
+        if path not in covered:
+            docids.append(docid)
+    print("%d out of %d catalog paths have no intid key." % (len(docids), count))
+    return [_catalog[docid] for docid in docids]
+
+
+def handle_site(site):
+    # Handle one Plone Site, and return a note for the summary.
     print("")
     print("Handling Plone Site %s." % site.id)
     setSite(site)
     catalog = api.portal.get_tool(name="portal_catalog")
     intids = getUtility(IIntIds)
     fixed_intid = 0
-    if hasattr(catalog, "getAllBrains"):
+    if options.by_path:
+        brains = get_uncovered_brains(catalog, intids)
+        total = len(brains)
+    elif hasattr(catalog, "getAllBrains"):
         brains = catalog.getAllBrains()
+        total = len(catalog)
     else:
         brains = catalog.unrestrictedSearchResults()
-    for brain in brains:
+        total = len(brains)
+    start = time.time()
+    batched = 0
+    for done, brain in enumerate(brains):
+        if options.batch_size and fixed_intid - batched >= options.batch_size:
+            commit_batch(
+                "Registered {0} intids for {1} so far".format(fixed_intid, site.id)
+            )
+            batched = fixed_intid
+        if options.batch_size and done and done % options.batch_size == 0:
+            site._p_jar.cacheGC()
+            log_progress(done, total, start)
         try:
             obj = brain.getObject()
         except (KeyError, ValueError, AttributeError):
@@ -85,7 +173,23 @@ for site in plones:
         print("No fixes were needed.")
         # Abort the transaction so we can start a new one.
         transaction.abort()
-        continue
+        return "No fixes were needed."
     note = "Registered {0} intids for {1}".format(fixed_intid, site.id)
     commit(note)
     print("Done.")
+    return note
+
+
+if options.jobs > 1:
+    # Load the helpers for --jobs from sitejobs.py next to this script.
+    here = os.path.dirname(os.path.abspath(sys.argv[2]))
+    sitejobs = runpy.run_path(os.path.join(here, "sitejobs.py"), run_name="sitejobs")
+    notes = sitejobs["run_site_jobs"](
+        app, [site.id for site in plones], handle_site, options.jobs, globals()
+    )
+else:
+    notes = [(site.id, handle_site(site)) for site in plones]
+print("")
+print("Summary:")
+for site_id, note in sorted(notes):
+    print("%s: %s" % (site_id, note))
@@ -0,0 +1,129 @@
+"""
+Helpers to run jobs in parallel worker processes, for the --jobs option of
+the scripts that handle Plone Sites, and --workers of catalogoptimize.py.
+
+This is not a script itself.  The scripts load it with runpy, from the
+directory of the script:
+
+  here = os.path.dirname(os.path.abspath(sys.argv[2]))
+  sitejobs = runpy.run_path(os.path.join(here, "sitejobs.py"), run_name="sitejobs")
+  notes = sitejobs["run_site_jobs"](app, site_ids, handle_site, jobs, globals())
+
+The workers are forked, so they get the functions of the script without
+pickling them.  Forking while the database of the parent is open is not
+safe: with ZEO the parent has a client thread that talks to the server,
+and the child gets a copy of its socket and locks, but not the thread.
+So run_jobs closes the database of the parent before it forks, and each
+worker opens the database again.  The parent cannot use its app after
+that.  Call open_app when it needs one.
+
+Each worker has its own database connection, so this needs ZEO.
+
+For updates and more such scripts, see https://github.com/zestsoftware/plonescripts
+"""
+
+import multiprocessing
+import queue
+
+import transaction
+from App.config import getConfiguration
+from Testing.makerequest import makerequest
+
+
+def open_app():
+    # Open the database again, from the same configuration, and return
+    # the Zope root with a request, like in bin/instance run.
+    dbtab = getConfiguration().dbtab
+    name = dbtab.getName("/")
+    db = dbtab.getDatabaseFactory(name=name).open(name, {})
+    return makerequest(db.open().root()["Application"])
+
+
+def close_app(app):
+    # Close the database of the parent, including the ZEO client thread.
+    transaction.abort()
+    app._p_jar.db().close()
+
+
+def worker(job_queue, result_queue, handle, namespace):
+    # Runs in a forked worker process, until it gets None from the queue.
+    # The functions of the script use its global app, so replace that.
+    # When we cannot open the database, report that once, with job None,
+    # and leave the jobs to the other workers.
+    try:
+        app = namespace["app"] = open_app()
+    except Exception as exc:
+        result_queue.put((None, None, repr(exc)))
+        return
+    for job in iter(job_queue.get, None):
+        try:
+            transaction.begin()
+            result = handle(job)
+            error = None
+        except (Exception, SystemExit) as exc:
+            transaction.abort()
+            result = None
+            error = repr(exc)
+        app._p_jar.cacheGC()
+        result_queue.put((job, result, error))
+
+
+def run_jobs(app, jobs, handle, number, namespace):
+    # Call handle(job) for each job in one of number worker processes.
+    # namespace is the globals of the script.
+    # Yield (job, result, error) as the jobs are done, with error None,
+    # or the repr of the exception, and then result None.
+    # Workers that cannot open the database are reported and left out.
+    close_app(app)
+    context = multiprocessing.get_context("fork")
+    job_queue = context.Queue()
+    result_queue = context.Queue()
+    for job in jobs:
+        job_queue.put(job)
+    workers = []
+    for count in range(min(number, len(jobs))):
+        job_queue.put(None)
+        process = context.Process(
+            target=worker, args=(job_queue, result_queue, handle, namespace)
+        )
+        process.start()
+        workers.append(process)
+    pending = len(jobs)
+    failed = 0
+    try:
+        while pending:
+            try:
+                result = result_queue.get(timeout=10)
+            except queue.Empty:
+                if not any([process.is_alive() for process in workers]):
+                    print(
+                        "ERROR: all workers have stopped, %d jobs are left." % pending
+                    )
+                    break
+                continue
+            if result[0] is None:
+                failed += 1
+                print("ERROR: worker could not open the database: %s" % result[2])
+                if failed == len(workers):
+                    print("ERROR: no workers are left, %d jobs are left." % pending)
+                    break
+                continue
+            pending -= 1
+            yield result
+    finally:
+        for process in workers:
+            process.join()
+
+
+def run_site_jobs(app, site_ids, handle_site, number, namespace):
+    # Handle the sites in worker processes.  Returns a list of (site id, note).
+    def site_job(site_id):
+        return handle_site(getattr(namespace["app"], site_id))
+
+    notes = []
+    for site_id, note, error in run_jobs(app, site_ids, site_job, number, namespace):
+        if error is not None:
+            note = "ERROR: %s" % error
+            print("ERROR handling Plone Site %s: %s" % (site_id, error))
+        notes.append((site_id, note))
+    return notes